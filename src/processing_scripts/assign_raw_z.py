@@ -27,13 +27,13 @@
 # 1. Initialization 
 # The script will read watershed IDs from the confog.ini file to determine what watershed to process. Then, a new 3D geometry column is created and populated with NODATA for now. 
 # 2. DEM File Indexing (indexDem function)
-# The script will scan the DEM directory for all elevation files and extract metadata from the files including: geographic bounds, cell/pixel dimensions, coordinate systems, and NoDATA values if they exist.
+# The script will scan the DEM directory for all elevation files and extract metadata from the files including: geographic bounds, cell/pixel dimensions, coordinate systems, and NoDATA values if they exist. The metadata is read from the GeoTIFF tags and stored in a DEM catalog file (dem_catalog.json in the DEM directory by default) so files are only read again when they change.
 # 3. Processing Workflow (processArea function)
-# The script will then make cartesian products from the intersection between the DEM extents and the stream segments from the defined database in the config.ini file. If the coordinate systems are different, then the script will transform the stream geometries to match that system of the DEM whose bounds it falls within. 
-# 4. Elevation Calculation (processCoordinate function)
-# This is the core algorithm that uses bilinear interpolation: For each point (vertex) on a stream segment, the script will identify the four surrounding DEM cells and take their elevations. The interpolated elevation is then calculated for both x and y axes by interpolating along the x and y axes sequentially based on the how close the original point is to the corners of the cells. Based on these weights, the (x,y) coordinate is then given an elevation value (i.e., now a (x,y,z) coordinate).
+# The script will then make cartesian products from the intersection between the DEM extents and the stream segments from the defined database in the config.ini file. If the coordinate systems are different, then the script will transform the stream geometries to match that system of the DEM whose bounds it falls within. DEM files are not read into memory in full; uncompressed files are memory mapped and for compressed files only the strips or tiles that stream vertices fall into are read (see DEMData). If elevation_workers is more than one, the DEM files are sampled in parallel worker processes and the results merged in DEM file order before they are written (see processAreas).
+# 4. Elevation Calculation (sampleElevation function)
+# This is the core algorithm that uses bilinear interpolation: For all points (vertices) of the stream segments in a DEM at once, the script will identify the four surrounding DEM cells and take their elevations. The interpolated elevation is then calculated for both x and y axes by interpolating along the x and y axes sequentially based on the how close the original point is to the corners of the cells. Based on these weights, the (x,y) coordinate is then given an elevation value (i.e., now a (x,y,z) coordinate).
 # 5. Handling Edge Cases
-# The script will then check for any points falling outside the geographic bounds of the DEMs. If there are no overlapping DEMs found within the original DEM directory, the the elevation value remains NoDATA.
+# Points near the edge of a DEM may need cells from neighbouring DEMs. These cells are read from the other DEM files in the same pass through a DEM mosaic (DEMMosaic), which finds the DEM containing a cell with a spatial index of the DEM extents and keeps the most recently used DEM files open. If no DEM contains the cell, the elevation value remains NoDATA.
 # The overall result is a stream network table where each LineString geometry now has accurate elevation values at every vertex.
 # 
 # 
@@ -42,14 +42,19 @@ import appconfig
 import os
 import numpy
 import tifffile as tif
-import shapely.wkb
-import shapely.geometry
-from math import floor
+import shapely
 import json
-import psycopg2.extras
+from collections import OrderedDict
 from psycopg2.extras import RealDictCursor
 import ast
 
+try:
+    from processing_scripts import bulk_update
+    from processing_scripts import parallel
+except ModuleNotFoundError:
+    import bulk_update
+    import parallel
+
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetTable = appconfig.config['PROCESSING']['stream_table']
@@ -65,7 +70,18 @@ dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 # demDir = appconfig.config['ELEVATION_PROCESSING']['dem_directory']
 demDir = appconfig.demDir
 
-demfiles = []
+#dem mosaic used to look up cells outside of the dem file being processed
+mosaic = None
+#number of dem files kept open by the mosaic
+demCacheSize = appconfig.config.getint('ELEVATION_PROCESSING', 'dem_cache_size', fallback=8)
+
+#number of worker processes used to sample dem files; 0 uses one per cpu
+elevationWorkers = parallel.getWorkerCount(appconfig.config.getint('ELEVATION_PROCESSING', 'elevation_workers', fallback=1))
+#limit on the stream coordinates (in MB) loaded for one batch of dem files
+elevationMemoryLimit = appconfig.config.getint('ELEVATION_PROCESSING', 'elevation_memory_limit', fallback=2048) * 1024 * 1024
+
+#bump if the details stored in the dem catalog change
+demCatalogVersion = 1
 
 class DEMFile:
     def __init__(self, filename, xmin, ymin, xmax, ymax, xcellsize, ycellsize, xcnt, ycnt, srid, nodata):
@@ -81,6 +97,181 @@ class DEMFile:
         self.srid = srid
         self.nodata = nodata
 
+class DEMData:
+    """
+    Read access to the cell values of a dem file. Uncompressed files are
+    memory mapped; for other files only the strips or tiles that contain
+    requested cells are read and decoded (and kept for later requests) so
+    memory use and reads scale with the stream footprint instead of the
+    size of the dem.
+    
+    Values are read by indexing with arrays of row and column indices:
+    demdata[rows, cols]
+    """
+    def __init__(self, filename):
+        self.tiff = tif.TiffFile(filename)
+        self.page = self.tiff.pages[0]
+        self.memmap = None
+        self.segments = {}
+        
+        if (self.page.is_contiguous):
+            self.memmap = tif.memmap(filename)
+        elif (self.page.is_tiled):
+            self.seglength = self.page.tilelength
+            self.segwidth = self.page.tilewidth
+        else:
+            self.seglength = self.page.rowsperstrip
+            self.segwidth = self.page.imagewidth
+        
+        if (self.memmap is None):
+            self.across = -(-self.page.imagewidth // self.segwidth)
+        
+    def __getitem__(self, index):
+        rows, cols = index
+        if (self.memmap is not None):
+            return self.memmap[rows, cols]
+        
+        rows = numpy.asarray(rows)
+        cols = numpy.asarray(cols)
+        values = numpy.empty(len(rows), dtype=self.page.dtype)
+        if (len(rows) == 0):
+            return values
+        
+        segs = (rows // self.seglength) * self.across + cols // self.segwidth
+        order = numpy.argsort(segs, kind='stable')
+        uniquesegs, starts = numpy.unique(segs[order], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+        
+        self.loadSegments(uniquesegs)
+        for seg, start, end in zip(uniquesegs, starts, ends):
+            idx = order[start:end]
+            values[idx] = self.segments[seg][rows[idx] % self.seglength, cols[idx] % self.segwidth]
+        return values
+    
+    def loadSegments(self, segs):
+        """
+        Reads and decodes the strips or tiles that have not been loaded yet
+        """
+        missing = [int(seg) for seg in segs if seg not in self.segments]
+        if (len(missing) == 0):
+            return
+        
+        page = self.page
+        offsets = [page.dataoffsets[seg] for seg in missing]
+        bytecounts = [page.databytecounts[seg] for seg in missing]
+        
+        for data, i in self.tiff.filehandle.read_segments(offsets, bytecounts):
+            seg = missing[i]
+            block = numpy.full((self.seglength, self.segwidth), page.nodata, dtype=page.dtype)
+            decoded, index, shape = page.decode(data, seg, jpegtables=page.jpegtables)
+            if (decoded is not None):
+                decoded = decoded[0, :, :, 0]
+                block[:decoded.shape[0], :decoded.shape[1]] = decoded
+            self.segments[seg] = block
+    
+    def close(self):
+        self.memmap = None
+        self.segments = {}
+        self.tiff.close()
+
+
+class DEMMosaic:
+    """
+    Looks up dem cell values at any location from a set of dem files.
+    The dem file containing a location is found with a spatial index 
+    (STRtree) of the dem file extents and the most recently used files 
+    are kept open.
+    """
+    def __init__(self, demfiles, cachesize):
+        self.demfiles = demfiles
+        self.srids = numpy.array([demfile.srid for demfile in demfiles], dtype=numpy.int64)
+        self.tree = shapely.STRtree([shapely.box(d.xmin, d.ymin, d.xmax, d.ymax) for d in demfiles])
+        self.cachesize = max(cachesize, 1)
+        self.cache = OrderedDict()
+    
+    def getData(self, index):
+        """
+        Returns the DEMData of the dem file, opening it if required
+        """
+        data = self.cache.get(index)
+        if (data is not None):
+            self.cache.move_to_end(index)
+            return data
+        
+        data = DEMData(self.demfiles[index].filename)
+        self.cache[index] = data
+        if (len(self.cache) > self.cachesize):
+            self.cache.popitem(last=False)[1].close()
+        return data
+    
+    def cellValues(self, x, y, srid):
+        """
+        Returns the values of the dem cells containing the points. If 
+        dem files overlap the first dem file is used.
+        
+        :param x: array of x coordinates
+        :param y: array of y coordinates
+        :param srid: srid of the coordinates; only dem files with this 
+            srid are searched
+        :return: tuple of array of cell values (appconfig.NODATA if the
+            point is not in any dem file) and boolean array that is true
+            if the value is the dem file nodata value
+        """
+        values = numpy.full(len(x), appconfig.NODATA, dtype=numpy.float64)
+        isnodata = numpy.zeros(len(x), dtype=bool)
+        if (len(x) == 0):
+            return values, isnodata
+        
+        pointindex, fileindex = self.tree.query(shapely.points(x, y), predicate='intersects')
+        keep = self.srids[fileindex] == srid
+        pointindex = pointindex[keep]
+        fileindex = fileindex[keep]
+        
+        #first dem file for each point
+        order = numpy.lexsort((fileindex, pointindex))
+        pointindex = pointindex[order]
+        fileindex = fileindex[order]
+        first = numpy.unique(pointindex, return_index=True)[1]
+        pointindex = pointindex[first]
+        fileindex = fileindex[first]
+        
+        for index in numpy.unique(fileindex):
+            demfile = self.demfiles[index]
+            points = pointindex[fileindex == index]
+            
+            xindex = numpy.floor((x[points] - demfile.xmin) / demfile.xcellsize).astype(numpy.int64)
+            yindex = demfile.ycnt - numpy.floor((y[points] - demfile.ymin) / abs(demfile.ycellsize)).astype(numpy.int64) - 1
+            #points on the max edges are in the last cell
+            xindex = numpy.clip(xindex, 0, demfile.xcnt - 1)
+            yindex = numpy.clip(yindex, 0, demfile.ycnt - 1)
+            
+            raw = self.getData(index)[yindex, xindex]
+            values[points] = raw
+            if (demfile.nodata is not None):
+                isnodata[points] = raw == demfile.nodata
+        
+        return values, isnodata
+    
+    def close(self):
+        for data in self.cache.values():
+            data.close()
+        self.cache.clear()
+
+
+class DEMArea:
+    """
+    Stream features that overlap a dem file
+    """
+    def __init__(self, demfile, srid, fids, geoms):
+        self.demfile = demfile
+        self.srid = srid
+        self.fids = fids
+        self.geoms = geoms
+        self.sizes = shapely.get_num_coordinates(geoms)
+        self.coords = shapely.get_coordinates(geoms, include_z=True)
+        #estimated memory use; coordinates, shared copy and results
+        self.size = 3 * self.coords.nbytes
+
 def getWatershedIds(conn):
     
     publicSchema = "public"
@@ -177,7 +368,9 @@ def prepareOutput(conn):
 #-- COMMENT ABOVE FUNCTIONS WITH MATCHING NAMES
 def indexDem(default_srid=None, assign_crs=False):
     """
-    Index DEM files with CRS handling.
+    Index DEM files with CRS handling. File details are kept in a
+    catalog file (see getCatalogFile) and only re-read for files that
+    are new or have changed since the last run.
     
     Args:
         default_srid: Default SRID to use for files with undefined CRS
@@ -189,66 +382,225 @@ def indexDem(default_srid=None, assign_crs=False):
     print("indexing dem files")
     demfiles = []
     
+    catalogfile = getCatalogFile()
+    catalog = loadCatalog(catalogfile)
+    entries = {}
+    
     for demfile in os.listdir(demDir):
         if (demfile.endswith('.tif') or demfile.endswith('.tiff')):
             filepath = os.path.join(demDir, demfile)
+            details = getCatalogEntry(filepath, catalog, entries)
             
             # Check if this file has undefined CRS and we want to assign one
-            if assign_crs and default_srid:
-                out = subprocess.run("\"" + appconfig.gdalsrsinfo + "\" -e -o epsg " + "\"" + filepath + "\"", capture_output=True)
-                srid_output = out.stdout.decode('utf-8').strip()
-                
-                if ':' in srid_output and srid_output.split(':')[1].strip() == '-1':
-                    # Create new file with CRS assigned
-                    filepath = assign_crs_to_file(filepath, default_srid)
-            
-            demfiles.append(getFileDetails(filepath, default_srid))
+            if assign_crs and default_srid and details['srid'] is None:
+                # Create new file with CRS assigned
+                filepath = assign_crs_to_file(filepath, default_srid)
+                details = getCatalogEntry(filepath, catalog, entries)
             
+            demfiles.append(toDEMFile(filepath, details, default_srid))
+    
+    saveCatalog(catalogfile, entries)
     return demfiles
 
+def getCatalogFile():
+    """
+    Returns the dem catalog file; configured with dem_catalog in the
+    ELEVATION_PROCESSING section, defaults to dem_catalog.json in the
+    dem directory
+    """
+    catalogfile = appconfig.config.get('ELEVATION_PROCESSING', 'dem_catalog', fallback='').strip()
+    if (catalogfile == ''):
+        catalogfile = os.path.join(demDir, 'dem_catalog.json')
+    return catalogfile
+
+def loadCatalog(catalogfile):
+    """
+    Loads the dem catalog; returns an empty catalog if the file
+    doesn't exist or can't be read
+    """
+    try:
+        with open(catalogfile, 'r') as f:
+            catalog = json.load(f)
+        if (catalog.get('version') == demCatalogVersion):
+            return catalog['files']
+    except (OSError, ValueError):
+        pass
+    return {}
+
+def saveCatalog(catalogfile, entries):
+    """
+    Writes the dem catalog; the catalog is only a cache so failing
+    to write it (for example a read-only dem directory) is not an error
+    """
+    try:
+        tmpfile = catalogfile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'version': demCatalogVersion, 'files': entries}, f, indent=1)
+        os.replace(tmpfile, catalogfile)
+    except OSError as e:
+        print(f"    Warning: unable to write dem catalog {catalogfile}: {e}")
+
+def getCatalogEntry(filepath, catalog, entries):
+    """
+    Returns the details of the dem file from the catalog, reading
+    them from the file if the file isn't in the catalog or the file
+    size or modified time has changed. The entry is added to entries.
+    """
+    key = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    
+    entry = catalog.get(key)
+    if (entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns):
+        entry = readFileDetails(filepath)
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime_ns
+        
+    entries[key] = entry
+    return entry
+
+def toDEMFile(demfile, details, default_srid=None):
+    
+    srid = details['srid']
+    if srid is None:
+        srid = handle_undefined_srid(demfile, details, default_srid)
+    
+    xsize = (details['xmax'] - details['xmin']) / details['xcnt']
+    ysize = (details['ymax'] - details['ymin']) / details['ycnt'] 
+    
+    return DEMFile(demfile, details['xmin'], details['ymin'], details['xmax'], details['ymax'], 
+        xsize, ysize, details['xcnt'], details['ycnt'], int(srid), details['nodata'])
+
 def getFileDetails(demfile, default_srid=None):
+    
+    return toDEMFile(demfile, readFileDetails(demfile), default_srid)
+
+def readFileDetails(demfile):
+    """
+    Reads the bounds, size, nodata value and EPSG code of the dem
+    file. These are read from the GeoTIFF tags; gdalinfo and gdalsrsinfo
+    are only used if they can't be determined from the tags.
+    
+    Returns:
+        Dictionary of file details; srid is None if undefined
+    """
     print("    reading: " + demfile)
     
-    # Try to get SRID from the file
-    out = subprocess.run("\"" + appconfig.gdalsrsinfo + "\" -e -o epsg " + "\"" + demfile + "\"", capture_output=True)
-    srid_output = out.stdout.decode('utf-8').strip()
+    details = readGeoTiffTags(demfile)
+    
+    if details is None:
+        out = subprocess.run("\"" + appconfig.gdalinfo + "\" -json " + "\"" + demfile + "\"", capture_output=True)
+        jsonout = out.stdout.decode('utf-8')
+        metadata = json.loads(jsonout)
+        
+        details = {
+            'xmin': metadata['cornerCoordinates']['lowerLeft'][0],
+            'ymin': metadata['cornerCoordinates']['lowerLeft'][1],
+            'xmax': metadata['cornerCoordinates']['upperRight'][0],
+            'ymax': metadata['cornerCoordinates']['upperRight'][1],
+            'xcnt': metadata['size'][0],
+            'ycnt': metadata['size'][1],
+            'nodata': metadata['bands'][0].get('noDataValue'),
+            'srid': None
+        }
+    
+    if details['srid'] is None:
+        # Try to get SRID with gdal; this can identify coordinate systems
+        # that are defined in the file without an EPSG code
+        out = subprocess.run("\"" + appconfig.gdalsrsinfo + "\" -e -o epsg " + "\"" + demfile + "\"", capture_output=True)
+        srid_output = out.stdout.decode('utf-8').strip()
+        
+        if ':' in srid_output:
+            srid = srid_output.split(':')[1].strip()
+            if srid != '-1' and srid != '':
+                details['srid'] = int(srid)
+    
+    #print(f"{details}")
+    return details
+
+def readGeoTiffTags(demfile):
+    """
+    Reads the file details from the GeoTIFF tags of the first page
+    of the file.
     
-    # Handle cases where SRID is undefined or -1
-    if ':' in srid_output:
-        srid = srid_output.split(':')[1].strip()
-        if srid == '-1' or srid == '':
-            srid = handle_undefined_srid(demfile, default_srid)
+    Returns:
+        Dictionary of file details or None if the file has no
+        supported georeferencing tags
+    """
+    with tif.TiffFile(demfile) as tiff:
+        page = tiff.pages[0]
+        tags = page.tags
+        
+        xcnt = page.imagewidth
+        ycnt = page.imagelength
+        
+        scale = tags.valueof(33550)       # ModelPixelScaleTag
+        tiepoint = tags.valueof(33922)    # ModelTiepointTag
+        transform = tags.valueof(34264)   # ModelTransformationTag
+        geokeys = tags.valueof(34735)     # GeoKeyDirectoryTag
+        nodata = tags.valueof(42113)      # GDAL_NODATA
+    
+    if scale is not None and tiepoint is not None and len(tiepoint) >= 6:
+        xsize = scale[0]
+        ysize = scale[1]
+        xmin = tiepoint[3] - tiepoint[0] * xsize
+        ymax = tiepoint[4] + tiepoint[1] * ysize
+    elif transform is not None and len(transform) >= 8 and transform[1] == 0 and transform[4] == 0:
+        xsize = transform[0]
+        ysize = -transform[5]
+        xmin = transform[3]
+        ymax = transform[7]
     else:
-        srid = handle_undefined_srid(demfile, default_srid)
+        return None
     
-    out = subprocess.run("\"" + appconfig.gdalinfo + "\" -json " + "\"" + demfile + "\"", capture_output=True)
-    jsonout = out.stdout.decode('utf-8')
-    metadata = json.loads(jsonout)
+    keys = {}
+    if geokeys is not None:
+        # header is (version, revision, minor revision, number of keys) followed
+        # by (key id, tag location, count, value) for each key; only keys with
+        # values stored in the directory itself (location 0) are needed
+        for i in range(geokeys[3]):
+            keyid, location, count, value = geokeys[4 + i * 4: 8 + i * 4]
+            if location == 0:
+                keys[keyid] = value
     
-    xmin = metadata['cornerCoordinates']['lowerLeft'][0]
-    ymin = metadata['cornerCoordinates']['lowerLeft'][1]
-    xmax = metadata['cornerCoordinates']['upperRight'][0]
-    ymax = metadata['cornerCoordinates']['upperRight'][1]
+    # GTRasterTypeGeoKey - gdal reports the bounds of pixel is point rasters
+    # as the outside edges of the pixels
+    if keys.get(1025) == 2:
+        xmin = xmin - 0.5 * xsize
+        ymax = ymax + 0.5 * ysize
     
-    xcnt = metadata['size'][0]
-    ycnt = metadata['size'][1]
+    # ProjectedCSTypeGeoKey or GeographicTypeGeoKey; 32767 is user defined
+    srid = None
+    modeltype = keys.get(1024)
+    for keyid in ((2048, 3072) if modeltype == 2 else (3072, 2048)):
+        if keys.get(keyid) not in (None, 0, 32767):
+            srid = int(keys[keyid])
+            break
     
-    xsize = (xmax - xmin) / xcnt
-    ysize = (ymax - ymin) / ycnt 
+    if nodata is not None:
+        try:
+            nodata = float(nodata.strip('\x00 '))
+        except ValueError:
+            nodata = None
     
-    nodata = metadata['bands'][0]['noDataValue']
-
-    #print(f'xmin: {xmin}\n ymin:{ymin}\n xmax:{xmax}\n ymax:{ymax}\n xsize:{xsize}\n ysize:{ysize}\n xcnt:{xcnt}\n ycnt:{ycnt}\n srid:{srid}\n nodata:{nodata}')
-
-    return DEMFile(demfile, xmin, ymin, xmax, ymax, xsize, ysize, xcnt, ycnt, int(srid), nodata)
+    return {
+        'xmin': float(xmin),
+        'ymin': float(ymax - ycnt * ysize),
+        'xmax': float(xmin + xcnt * xsize),
+        'ymax': float(ymax),
+        'xcnt': xcnt,
+        'ycnt': ycnt,
+        'nodata': nodata,
+        'srid': srid
+    }
 
 # Handle undefined SRID by guessing or using default (to be commented out if not needed)
-def handle_undefined_srid(demfile, default_srid=None):
+def handle_undefined_srid(demfile, details, default_srid=None):
     """
     Handle DEM files with undefined SRID by guessing or using default.
     
     Args:
         demfile: Path to the DEM file
+        details: File details (bounds) from the dem catalog
         default_srid: Default SRID to use if provided
     
     Returns:
@@ -260,18 +612,8 @@ def handle_undefined_srid(demfile, default_srid=None):
         print(f"    Using provided default SRID: {default_srid}")
         return str(default_srid)
     
-    # Try to guess based on coordinate bounds
-    out = subprocess.run("\"" + appconfig.gdalinfo + "\" -json " + "\"" + demfile + "\"", capture_output=True)
-    jsonout = out.stdout.decode('utf-8')
-    metadata = json.loads(jsonout)
-    
-    xmin = metadata['cornerCoordinates']['lowerLeft'][0]
-    ymin = metadata['cornerCoordinates']['lowerLeft'][1]
-    xmax = metadata['cornerCoordinates']['upperRight'][0]
-    ymax = metadata['cornerCoordinates']['upperRight'][1]
-    
     # Guess CRS based on coordinate ranges
-    guessed_srid = guess_srid_from_bounds(xmin, ymin, xmax, ymax)
+    guessed_srid = guess_srid_from_bounds(details['xmin'], details['ymin'], details['xmax'], details['ymax'])
     #print(f"    Guessed SRID based on bounds: {guessed_srid}")
     
     return str(guessed_srid)
@@ -341,9 +683,13 @@ def assign_crs_to_file(input_file, srid, output_file=None):
         print(f"    Error running gdal_translate: {e}")
         return input_file
     
-def processArea(demfile, connection, watershed_id, onlymissing = False):
-    print("    processing: " + (demfile.filename))
+def getAreaFeatures(demfile, connection, watershed_id):
+    """
+    Loads the stream features that overlap the dem file
     
+    :return: tuple of the srid of the stream table, list of feature ids 
+        and array of feature geometries (in the dem srid)
+    """
     #get edges
     query = f"""
         SELECT srid 
@@ -359,183 +705,264 @@ def processArea(demfile, connection, watershed_id, onlymissing = False):
         cursor.execute(query)
         srid = cursor.fetchone()[0]
     
-    if onlymissing: 
-        #only load features with at least one missing elevation values  
-        query = f"""
-            WITH ids AS (
-                SELECT distinct id FROM (
-                    SELECT {appconfig.dbIdField}, st_z ((ST_DumpPoints({dbTargetGeom})).geom ) AS z 
-                    FROM {dbTargetSchema}.{dbTargetTable}
-                ) foo WHERE foo.z = {appconfig.NODATA}
-            ),
-            env AS (
-                SELECT st_transform(
-                  st_setsrid(
-                    st_makebox2d(st_point({demfile.xmin}, {demfile.ymin}), st_point({demfile.xmax}, {demfile.ymax})), 
-                      {demfile.srid}
-                  ),{srid}
-                ) as bbox
-            )
-            SELECT t.{appconfig.dbIdField} as id, st_transform(t.{dbTargetGeom}, {demfile.srid}) as geometry
-            FROM {dbTargetSchema}.{dbTargetTable} t, env
-            WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} IN {watershed_id}
-            AND t.{appconfig.dbIdField} in (select id from ids);
-        """
-    else:
-        #load all features
-        query = f"""
-            WITH
-            env AS (
-                SELECT st_transform(
-                  st_setsrid(
-                    st_makebox2d(st_point({demfile.xmin}, {demfile.ymin}), st_point({demfile.xmax}, {demfile.ymax})), 
-                      {demfile.srid}
-                  ),{srid}
-                ) as bbox
-            )
-            SELECT t.{appconfig.dbIdField} as id, st_transform(t.{dbTargetGeom}, {demfile.srid}) as geometry
-            FROM {dbTargetSchema}.{dbTargetTable} t, env
-            WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} IN {watershed_id}
-        """
+    query = f"""
+        WITH
+        env AS (
+            SELECT st_transform(
+              st_setsrid(
+                st_makebox2d(st_point({demfile.xmin}, {demfile.ymin}), st_point({demfile.xmax}, {demfile.ymax})), 
+                  {demfile.srid}
+              ),{srid}
+            ) as bbox
+        )
+        SELECT t.{appconfig.dbIdField} as id, st_transform(t.{dbTargetGeom}, {demfile.srid}) as geometry
+        FROM {dbTargetSchema}.{dbTargetTable} t, env
+        WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} IN {watershed_id}
+    """
 
-    newvalues = [] 
-    
     with connection.cursor() as cursor:
-        
-            cursor.execute(query)
-            features = cursor.fetchall()
-            if (len(features) == 0):
-                return
-            print("      reading dem")
-            imarray = numpy.array(tif.imread(demfile.filename))
-            
-            print("      processing")
-            for feature in features:
-                geom = shapely.wkb.loads(feature[1] , hex=True)
-                fid = feature[0]
-                #print("processing: " + str(fid))
-                ls = processGeometry(geom, demfile, imarray, onlymissing)
-                newvalues.append(  (shapely.wkb.dumps(ls), fid) )
-                
-            imarray = None
-            connection.commit()
+        cursor.execute(query)
+        features = cursor.fetchall()
+    connection.commit()
     
-    print("      saving results")
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetTable} 
-        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{srid})
-        WHERE {appconfig.dbIdField} = %s
-    """
+    fids = [feature[0] for feature in features]
+    geoms = shapely.from_wkb([feature[1] for feature in features])
+    return srid, fids, geoms
+
+
+def writeAreaFeatures(connection, srid, fids, geoms):
     
-    with connection.cursor() as cursor2:
-        psycopg2.extras.execute_batch(cursor2, updatequery, newvalues)
+    print("      saving results")
+    newvalues = list(zip(fids, shapely.to_wkb(geoms)))
+    columns = [(appconfig.dbIdField, 'uuid'), (dbTargetGeom, 'bytea')]
+    assign = {dbTargetGeom: f"st_setsrid(st_geomfromwkb(s.{dbTargetGeom}),{srid})"}
+    bulk_update.updateTable(connection, dbTargetSchema, dbTargetTable, columns, newvalues, assign)
             
     connection.commit()
+
+
+def processArea(demfile, connection, watershed_id):
+    print("    processing: " + (demfile.filename))
     
+    srid, fids, geoms = getAreaFeatures(demfile, connection, watershed_id)
+    if (len(fids) == 0):
+        return
     
+    print("      reading dem")
+    imarray = DEMData(demfile.filename)
     
-def processGeometry(geom, demfile, demdata, onlymissing):
+    print("      processing")
+    #sample all vertices of all features at once
+    coords = shapely.get_coordinates(geoms, include_z=True)
+    coords[:, 2] = sampleElevation(coords, demfile, imarray, mosaic)
+    geoms = shapely.set_coordinates(geoms, coords)
     
-    newpnts = []
-    for c in geom.coords:
-        x = c[0]
-        y = c[1]
-        z = c[2]
-        newpnts.append(processCoordinate(x, y, z, demfile, demdata, onlymissing))
-            
-    #make a geometry from newpnts
-    ls = shapely.geometry.LineString(newpnts)
-    return ls   
+    imarray.close()
+    
+    writeAreaFeatures(connection, srid, fids, geoms)
+
+
+def processAreas(demfiles, connection, watershed_id):
+    """
+    Computes the elevations for all dem files. If more than one worker
+    is configured the dem files are sampled in worker processes; stream
+    features are loaded and results written in batches limited by the
+    configured memory limit.
+    
+    Cells of the surrounding dem files are read through a DEMMosaic
+    so points near the edges of dem files are computed in one pass.
+    """
+    global mosaic
+    mosaic = DEMMosaic(demfiles, demCacheSize)
+    try:
+        if (not parallel.isParallel(elevationWorkers) or len(demfiles) <= 1):
+            for demfile in demfiles:
+                processArea(demfile, connection, watershed_id)
+            return
+    
+        batch = []
+        batchsize = 0
+        for demfile in demfiles:
+            print("    loading: " + (demfile.filename))
+            area = loadArea(demfile, connection, watershed_id)
+            if (area is None):
+                continue
+        
+            if (len(batch) > 0 and batchsize + area.size > elevationMemoryLimit):
+                processBatch(batch, connection)
+                batch = []
+                batchsize = 0
+                #reload as the features may have been updated by the batch
+                area = loadArea(demfile, connection, watershed_id)
+        
+            batch.append(area)
+            batchsize += area.size
+    
+        if (len(batch) > 0):
+            processBatch(batch, connection)
+    finally:
+        mosaic.close()
+        mosaic = None
 
 
-def processCoordinate(x, y, z, demfile, demdata, onlymissing):
+def loadArea(demfile, connection, watershed_id):
+    
+    srid, fids, geoms = getAreaFeatures(demfile, connection, watershed_id)
+    if (len(fids) == 0):
+        return None
+    return DEMArea(demfile, srid, fids, geoms)
 
-    #find the dem cell and use that for now
-    xindex = floor((x - demfile.xmin) / demfile.xcellsize)
-    yindex = demfile.ycnt - floor((y - demfile.ymin) / abs(demfile.ycellsize)) - 1
-         
-    centerx = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    centery = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
-            
-    if ( x < centerx ):
-        xindex2 = xindex - 1
-    else:
-        xindex2 = xindex + 1
-                
-    if ( y < centery ):
-        yindex2 = yindex + 1
-    else:
-        yindex2 = yindex - 1
-     
-    
-    if (onlymissing == False):
-        #if out of range return no data for now - we will go back and deal with 
-        #points that require multiple files later
-        #often dem files will overlap a bit so this edge will
-        #be processed by another area
-        if (xindex < 0 or xindex >= demfile.xcnt or yindex < 0 or yindex >= demfile.ycnt  or
-            xindex2 < 0 or xindex2 >= demfile.xcnt or yindex2 < 0 or yindex2 >= demfile.ycnt ): 
-            return [x, y, z]
-   
-    
-    x1 = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    x2 = xindex2 * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    y1 = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
-    y2 =  (demfile.ycnt - yindex2 -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
-    
-    if (xindex >= 0 and yindex >= 0 and xindex < demfile.xcnt and yindex < demfile.ycnt):
-        zx1y1 = demdata[yindex][xindex]
-    else:
-        zx1y1 = findElevation(x1, y1)
+
+def processBatch(batch, connection):
+    
+    print(f"    processing {len(batch)} dem files with {elevationWorkers} workers")
+    
+    parallel.share({str(i): area.coords for i, area in enumerate(batch)}, elevationWorkers)
+    try:
+        tasks = [(str(i), area.demfile) for i, area in enumerate(batch)]
+        results = parallel.mapTasks(sampleArea, tasks, elevationWorkers)
+    finally:
+        parallel.release()
+    
+    #merge the results in dem file order so where dem files overlap 
+    #the result matches processing the files one after another
+    featureindex = {}
+    featuregeoms = []
+    featuresizes = []
+    for area in batch:
+        for fid, geom, size in zip(area.fids, area.geoms, area.sizes):
+            if fid not in featureindex:
+                featureindex[fid] = len(featuregeoms)
+                featuregeoms.append(geom)
+                featuresizes.append(size)
+    
+    featuresizes = numpy.array(featuresizes, dtype=numpy.int64)
+    featurestart = numpy.cumsum(featuresizes) - featuresizes
+    merged = numpy.full((featuresizes.sum(), 3), numpy.nan)
+    
+    for area, (values, updated) in zip(batch, results):
+        coords = area.coords
+        sizes = area.sizes
         
-    if (xindex2 >= 0 and yindex >= 0 and xindex2 < demfile.xcnt and yindex < demfile.ycnt):
-        zx2y1 = demdata[yindex][xindex2]
-    else:
-        zx2y1 = findElevation(x2, y1)
+        index = numpy.array([featureindex[fid] for fid in area.fids], dtype=numpy.int64)
+        localstart = numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        position = numpy.repeat(featurestart[index], sizes) + numpy.arange(len(coords)) - localstart
         
-    if (xindex2 >= 0 and yindex2 >= 0 and xindex2 < demfile.xcnt and yindex2 < demfile.ycnt):
-        zx2y2 = demdata[yindex2][xindex2]
-    else:
-        zx2y2 = findElevation(x2, y2)
+        z = merged[position, 2]
+        first = numpy.isnan(merged[position, 0])
+        z[first] = coords[first, 2]
+        z[updated] = values[updated]
         
-    if (xindex >= 0 and yindex2 >= 0 and xindex < demfile.xcnt and yindex2 < demfile.ycnt):    
-        zx1y2 = demdata[yindex2][xindex]
-    else:
-        zx1y2 = findElevation(x1, y2)
-                
-    if (zx1y1 == appconfig.NODATA or zx1y2 == appconfig.NODATA or zx2y2 == appconfig.NODATA or zx1y2 == appconfig.NODATA):
-        #no data for this points
-        return [x,y,z]
-               
-    if (zx1y1 == demfile.nodata or zx2y1 == demfile.nodata or
-        zx2y1 == demfile.nodata or zx2y2 == demfile.nodata ):
-        #not enough data to determine
-        return [x, y, appconfig.NODATA]
-        
-    #bilinear interpolation of  elevation
-    fxy1 = ((x2 - x) / (x2- x1))*zx1y1 + ((x - x1)/(x2 - x1))*zx2y1
-    fxy2 = ((x2 - x) / (x2- x1))*zx1y2 + ((x - x1)/(x2 - x1))*zx2y2
-    fxy = ((y2 - y) / (y2 - y1))*fxy1 + ((y - y1)/(y2 - y1))*fxy2
-        
-    return [x,y,fxy]
-
-
-def findElevation(x, y):
-    #search through all dem files for elevation at that point
-    #determine by dropping coordinate into dem; should be centered if all dem's are the same
-    #but if not won't worry about it for these purposes
-    for demfile in demfiles:
-        if (demfile.xmin <= x and demfile.xmax >= x and demfile.ymin <= y and demfile.ymax >= y ):
-            #read file
-            xindex = floor((x - demfile.xmin) / demfile.xcellsize)
-            yindex = demfile.ycnt - floor((y - demfile.ymin) / abs(demfile.ycellsize)) - 1
-            
-            memmap_image = tif.memmap(demfile.filename)
-            z = memmap_image[yindex][xindex]
-            del memmap_image
-            return z
+        merged[position, 0:2] = coords[:, 0:2]
+        merged[position, 2] = z
+    
+    geoms = shapely.set_coordinates(numpy.array(featuregeoms, dtype=object), merged)
+    writeAreaFeatures(connection, batch[0].srid, list(featureindex.keys()), geoms)
+
+
+def sampleArea(task):
+    #computes the elevations for the coordinates of one dem file
+    name, demfile = task
+    coords = parallel.shared[name]
+    
+    demdata = DEMData(demfile.filename)
+    try:
+        return computeElevation(coords, demfile, demdata, mosaic)
+    finally:
+        demdata.close()
+
+
+def sampleElevation(coords, demfile, demdata, mosaic = None):
+    """
+    Computes the elevation of each coordinate by bilinear interpolation
+    of the four dem cells surrounding it
+    
+    :param coords: (n, 3) array of x, y, z coordinates in the dem srid
+    :param demfile: dem file details
+    :param demdata: dem raster values
+    :param mosaic: DEMMosaic used to find the values of surrounding cells
+        outside of the dem; if not provided (or the cells aren't in any
+        dem file) these coordinates keep their current z value
+    :return: array of n elevation values
+    """
+    values, updated = computeElevation(coords, demfile, demdata, mosaic)
+    z = coords[:, 2].copy()
+    z[updated] = values[updated]
+    return z
+
+
+def computeElevation(coords, demfile, demdata, mosaic = None):
+    """
+    Computes the elevation of the coordinates that can be determined
+    from the dem (see sampleElevation)
+    
+    :return: tuple of array of n elevation values and boolean array
+        that is true for the coordinates where the elevation was computed
+    """
+    x = coords[:, 0]
+    y = coords[:, 1]
+    
+    xcellsize = demfile.xcellsize
+    ycellsize = abs(demfile.ycellsize)
+    
+    #find the dem cell and the neighbouring cells closest to the point
+    xindex = numpy.floor((x - demfile.xmin) / xcellsize).astype(numpy.int64)
+    yindex = demfile.ycnt - numpy.floor((y - demfile.ymin) / ycellsize).astype(numpy.int64) - 1
+    
+    x1 = xindex * xcellsize + demfile.xmin + 0.5 * xcellsize
+    y1 = (demfile.ycnt - yindex - 1) * ycellsize + demfile.ymin + 0.5 * ycellsize
+    
+    xindex2 = numpy.where(x < x1, xindex - 1, xindex + 1)
+    yindex2 = numpy.where(y < y1, yindex + 1, yindex - 1)
+    
+    x2 = xindex2 * xcellsize + demfile.xmin + 0.5 * xcellsize
+    y2 = (demfile.ycnt - yindex2 - 1) * ycellsize + demfile.ymin + 0.5 * ycellsize
+    
+    def inDem(xi, yi):
+        return (xi >= 0) & (xi < demfile.xcnt) & (yi >= 0) & (yi < demfile.ycnt)
+    
+    #points outside the dem are processed with the dem they fall in
+    todo = inDem(xindex, yindex)
+    
+    def cellValues(xi, yi, cx, cy):
+        #returns the dem values and a nodata flag for each cell
+        values = numpy.full(len(xi), appconfig.NODATA, dtype=numpy.float64)
+        isnodata = numpy.zeros(len(xi), dtype=bool)
+        inside = inDem(xi, yi)
+        raw = demdata[yi[inside], xi[inside]]
+        values[inside] = raw
+        if (demfile.nodata is not None):
+            isnodata[inside] = raw == demfile.nodata
+        if (mosaic is not None and not inside.all()):
+            values[~inside], isnodata[~inside] = mosaic.cellValues(cx[~inside], cy[~inside], demfile.srid)
+        return values, isnodata
+        
+    x = x[todo]; y = y[todo]
+    x1 = x1[todo]; x2 = x2[todo]; y1 = y1[todo]; y2 = y2[todo]
+    
+    zx1y1, n11 = cellValues(xindex[todo], yindex[todo], x1, y1)
+    zx2y1, n21 = cellValues(xindex2[todo], yindex[todo], x2, y1)
+    zx2y2, n22 = cellValues(xindex2[todo], yindex2[todo], x2, y2)
+    zx1y2, n12 = cellValues(xindex[todo], yindex2[todo], x1, y2)
+    
+    #bilinear interpolation of elevation
+    fxy1 = ((x2 - x) / (x2 - x1)) * zx1y1 + ((x - x1) / (x2 - x1)) * zx2y1
+    fxy2 = ((x2 - x) / (x2 - x1)) * zx1y2 + ((x - x1) / (x2 - x1)) * zx2y2
+    fxy = ((y2 - y) / (y2 - y1)) * fxy1 + ((y - y1) / (y2 - y1)) * fxy2
     
-    return appconfig.NODATA    
+    #not enough data to determine
+    fxy[n11 | n21 | n22 | n12] = appconfig.NODATA
+    
+    #no data for these points; keep the current value
+    missing = ((zx1y1 == appconfig.NODATA) | (zx2y1 == appconfig.NODATA) | 
+        (zx2y2 == appconfig.NODATA) | (zx1y2 == appconfig.NODATA))
+    
+    updated = numpy.zeros(len(coords), dtype=bool)
+    updated[numpy.flatnonzero(todo)[~missing]] = True
+    values = numpy.full(len(coords), appconfig.NODATA, dtype=numpy.float64)
+    values[updated] = fxy[~missing]
+    return values, updated
+
 
 #--- main program ---
 # def main(demfiles):
@@ -588,18 +1015,8 @@ def main(demfiles=None, default_srid=None, assign_crs=False):
         
         #process each dem file
         print("Computing Elevations")
-        for demfile in demfiles:
-            processArea(demfile, conn, watershed_id)
-    
-        #search for any missing coordinates that may require 
-        #multiple dem files to compute
-        #if we have one giant dem file then ignore this
-        if (len(demfiles) > 1):
-            print ("  computing overlap areas")
-            for demfile in demfiles:
-                print(demfile.filename)
-                processArea(demfile, conn, watershed_id, True)
-                
+        processAreas(demfiles, conn, watershed_id)
+
 
     print("done")
 
@@ -20,8 +20,29 @@
 # snaps barriers to the stream table
 # ASSUMPTION - data is in equal area projection where distance functions return values in metres
 #
+# Split stream segments keep the raw and smoothed elevations of the
+# segment they were split from (z values at the break points are
+# interpolated), so elevations don't need to be recomputed after
+# the streams are broken.
+#
+# Gradient barriers are found in one pass over the vertex gradient table
+# ordered by mainstem and measure (see findGradientBarriers): a barrier
+# is added where the gradient rises above the minimum species gradient.
+# For the first vertex of a mainstem the downstream ends of the streams
+# it is on are looked up in the stream network (nodes matched within
+# 0.01) rather than with a spatial query per vertex. The barriers and
+# their passability are inserted in bulk.
+#
 import appconfig
-from imagecodecs.imagecodecs import NONE
+import numpy as np
+import bisect
+
+try:
+    from processing_scripts import stream_network
+    from processing_scripts import bulk_update
+except ModuleNotFoundError:
+    import stream_network
+    import bulk_update
 
 import sys
 
@@ -37,6 +58,7 @@ dbModelledCrossingsTable = appconfig.config['CROSSINGS']['modelled_crossings_tab
 dbCrossingsTable = appconfig.config['CROSSINGS']['crossings_table']
 dbVertexTable = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
+dbRawGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 dbGradientBarrierTable = appconfig.config['BARRIER_PROCESSING']['gradient_barrier_table']
 dbHabAccessUpdates = "habitat_access_updates"
 specCodes = appconfig.config[iniSection]['species']
@@ -56,27 +78,96 @@ w2 = 0.75
 #         cursor.execute(query)
 #         specCodes = cursor.fetchall()
 
-def insertPassability(conn, passability_data):
+def findGradientBarriers(conn, mingradient):
     """
-    Insert data into the barrier_passability table
+    Finds the gradient barriers: the vertices where the vertex gradient 
+    rises above mingradient going upstream along a mainstem. The first
+    vertex of a mainstem is only a barrier if there is a vertex with a 
+    gradient <= mingradient at the downstream end of one of the streams 
+    the vertex is on (the stream containing it or any stream starting or
+    ending at it). Points are matched within 0.01.
+    
+    :return: (x, y) arrays of the barrier points
     """
-    if len(passability_data) == 0:
-        return
-
-    insertquery = f"""
-        INSERT INTO {dbTargetSchema}.barrier_passability (
-            barrier_id
-            ,species_id
-            ,species_code
-            ,passability_status
-        )
-        VALUES(%s, %s, %s, %s);
+    query = f"""
+        SELECT mainstem_id, downstream_route_measure, st_x(vertex_pnt), st_y(vertex_pnt), gradient
+        FROM {dbTargetSchema}.{dbVertexTable}
+        ORDER BY mainstem_id, downstream_route_measure
     """
-
     with conn.cursor() as cursor:
-        for feature in passability_data:
-            cursor.execute(insertquery, feature)
-    conn.commit()
+        cursor.execute(query)
+        features = cursor.fetchall()
+    
+    mainstems = [feature[0] for feature in features]
+    values = np.array([feature[1:5] for feature in features], dtype=np.float64).reshape(-1, 4)
+    measure = values[:, 0]
+    x = values[:, 1]
+    y = values[:, 2]
+    above = values[:, 3] > mingradient
+    
+    first = np.ones(len(features), dtype=bool)
+    first[1:] = [mainstems[i] != mainstems[i - 1] for i in range(1, len(mainstems))]
+    
+    #start of a run of vertices above the gradient along a mainstem
+    barrier = above & ~first
+    barrier[1:] &= ~above[:-1]
+    
+    check = np.flatnonzero(above & first)
+    if (len(check) == 0):
+        return x[barrier], y[barrier]
+    
+    network = stream_network.getNetwork(conn, dbTargetSchema, dbTargetStreamTable)
+    
+    #streams of each mainstem ordered by measure
+    query = f"""
+        SELECT a.{appconfig.dbIdField}, a.mainstem_id, a.downstream_route_measure
+        FROM {dbTargetSchema}.{dbTargetStreamTable} a
+        WHERE a.mainstem_id IS NOT NULL
+        ORDER BY a.mainstem_id, a.downstream_route_measure
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        streamfeatures = cursor.fetchall()
+    
+    streams = {}
+    streamedges = network.indexOf([feature[0] for feature in streamfeatures]).tolist()
+    for feature, edge in zip(streamfeatures, streamedges):
+        measures, edges = streams.setdefault(feature[1], ([], []))
+        measures.append(feature[2])
+        edges.append(edge)
+    
+    #nodes with a vertex at or below the gradient
+    lownode = np.zeros(network.nodeCount, dtype=bool)
+    lownode[network.findNodes(x[~above], y[~above], 0.01)[1]] = True
+    
+    #streams starting or ending at the vertices to check
+    candidates = [[] for i in check]
+    points, nodes = network.findNodes(x[check], y[check], 0.01)
+    for point, node in zip(points.tolist(), nodes.tolist()):
+        candidates[point].extend(network.getInEdges(node).tolist())
+        candidates[point].extend(network.getOutEdges(node).tolist())
+    
+    for i, edges in zip(check.tolist(), candidates):
+        if (mainstems[i] in streams):
+            #the stream with downstream measure < vertex measure <= upstream measure
+            measures, mainstemedges = streams[mainstems[i]]
+            edges.append(mainstemedges[max(bisect.bisect_left(measures, measure[i]) - 1, 0)])
+        edges = [edge for edge in edges if edge >= 0]
+        if (len(edges) > 0 and lownode[network.toNode[edges]].any()):
+            barrier[i] = True
+    
+    return x[barrier], y[barrier]
+
+def subLine(geometry):
+    #sql expression for the part of the parent 3d geometry matching
+    #a split stream piece; the parent z values are kept and z values
+    #at the break points are interpolated
+    return f"""
+        CASE WHEN z.startmeasure < z.endmeasure 
+        THEN st_linesubstring({geometry}, z.startmeasure, z.endmeasure)
+        ELSE st_makeline(st_lineinterpolatepoint({geometry}, z.startmeasure), 
+            st_lineinterpolatepoint({geometry}, z.startmeasure))
+        END"""
 
 def breakstreams (conn):
         
@@ -138,138 +229,47 @@ def breakstreams (conn):
         features = cursor.fetchall()
         mingradient = features[0][0]
         code = features[0][1]
+    
+    x, y = findGradientBarriers(conn, mingradient)
+    
+    # insert all gradient barriers at once
+    columns = [('x', 'double precision'), ('y', 'double precision')]
+    with conn.cursor() as cursor:
+        staging = bulk_update.createStagingTable(cursor, dbTargetSchema, f"{dbGradientBarrierTable}_staging", columns)
+        bulk_update.copyRows(cursor, staging, columns, zip(x.tolist(), y.tolist()))
+        cursor.execute(f"""
+            INSERT INTO {dbTargetSchema}.{dbGradientBarrierTable} (point, id, type, passability_status_{code}) 
+                SELECT st_setsrid(st_makepoint(x, y), {appconfig.dataSrid}), gen_random_uuid(), 'gradient_barrier', 0
+                FROM {staging};
+            
+            DROP TABLE {staging};
+        """)
         
-    query = f"""    
-        SELECT mainstem_id, st_Force2d(vertex_pnt), gradient
-        FROM {dbTargetSchema}.{dbVertexTable}
-        ORDER BY mainstem_id, downstream_route_measure
+        # set gradient barriers to be passable for all other species
+        othercols = [f"passability_status_{species[0]} = 1" for species in specCodes if species[0] != code]
+        if len(x) > 0 and len(othercols) > 0:
+            cursor.execute(f"""
+                UPDATE {dbTargetSchema}.{dbGradientBarrierTable} SET {', '.join(othercols)};
+            """)
+    conn.commit()
+
+    # add gradient barriers to passability table; impassable 
+    # for the species with the minimum gradient and passable 
+    # for all other species
+    query = f"""
+        INSERT INTO {dbTargetSchema}.barrier_passability (
+            barrier_id
+            ,species_id
+            ,species_code
+            ,passability_status
+        )
+        SELECT b.id, f.id, f.code, CASE WHEN f.code = '{code}' THEN 0 ELSE 1 END
+        FROM {dbTargetSchema}.{dbGradientBarrierTable} b, {dbTargetSchema}.fish_species f
+        WHERE b.id NOT IN (SELECT barrier_id FROM {dbTargetSchema}.barrier_passability)
     """
-        
     with conn.cursor() as cursor:
         cursor.execute(query)
-        
-        features = cursor.fetchall()
-        
-        lastmainstem = NONE
-        lastgradient = -1
-        
-        for feature in features:
-            mainstem = feature[0]
-            point = feature[1]
-            gradient = feature[2]
-            
-            insert = False
-            if (lastmainstem != mainstem and gradient > mingradient):
-                #we need to find what the gradient is at the downstream point here
-                # and only add this as a break point
-                # if downstream vertex is < 0.15
-                query = f"""
-                
-                    with pnt as (
-                        SELECT st_endpoint(a.geometry) as endpnt
-                        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-                        WHERE st_intersects( a.geometry, '{point}')
-                    )
-                    SELECT gradient
-                    FROM {dbTargetSchema}.{dbVertexTable} a, pnt
-                    WHERE a.vertex_pnt && pnt.endpnt
-                    AND gradient <= {mingradient}
-                """ 
-                #print(query)
-                with conn.cursor() as cursor3:
-                    cursor3.execute(query)
-                    features3 = cursor3.fetchall()
-                    if (len(features3) > 0):
-                        insert = True
-    
-                
-
-            elif (gradient > mingradient) and \
-                not((lastgradient > mingradient and gradient > mingradient and lastmainstem == mainstem)):
-                
-                insert = True
-            
-            if insert:
-                # this is a point that is not the first point on a new mainstem 
-                # has a gradient larger than required values
-                # and has a downstream gradient that is less than required values  
-                query = f"""INSERT INTO {dbTargetSchema}.{dbGradientBarrierTable} (point, id, type, passability_status_{code}) values ('{point}', gen_random_uuid(), 'gradient_barrier', 0);""" 
-                with conn.cursor() as cursor2:
-                    cursor2.execute(query)
-
-                # set gradient barriers to be passable for all other species
-                for species in specCodes:
-                    if species[0] != code:
-                        foo = species[0]
-                        col = "passability_status_" + foo
-                        query = f"""
-                            UPDATE {dbTargetSchema}.{dbGradientBarrierTable} SET {col} = 1;
-                        """
-                        with conn.cursor() as cursor2:
-                            cursor2.execute(query)
-                    else:
-                        continue
-
-            lastmainstem = mainstem
-            lastgradient = gradient
-
-        # add gradient barriers to passability table
-        query = f"""
-            SELECT id
-            FROM {dbTargetSchema}.{dbGradientBarrierTable}
-            WHERE id NOT IN (SELECT barrier_id FROM {dbTargetSchema}.barrier_passability)
-        """
-
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            feature_data = cursor.fetchall()
-        conn.commit()
-
-        query = f"""
-            SELECT id, code
-            FROM {dbTargetSchema}.fish_species
-            WHERE code = '{code}'
-        """ 
-        # print(query)
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            species = cursor.fetchall()
-        conn.commit()
-
-        query = f"""
-            SELECT id, code
-            FROM {dbTargetSchema}.fish_species
-            WHERE code != '{code}'
-        """
-        # print(query)
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            other_species = cursor.fetchall()
-        conn.commit()
-
-        passability_data = []
-        other_passability_data = [] # barriers passable for all other species
-
-        for feature in feature_data:
-            passability_feature = []
-            other_passability_feature = []
-            for s in species:
-                passability_feature.append(feature[0])
-                passability_feature.append(s[0])
-                passability_feature.append(s[1])
-                passability_feature.append(0)
-            for s in other_species:
-                other_passability_feature.append(feature[0])
-                other_passability_feature.append(s[0])
-                other_passability_feature.append(s[1])
-                other_passability_feature.append(1)
-            if len(passability_feature) != 0:
-                passability_data.append(passability_feature)
-            if len(other_passability_feature) != 0:
-                other_passability_data.append(other_passability_feature)
-        
-        insertPassability(conn, passability_data)
-        insertPassability(conn, other_passability_data)
+    conn.commit()
    
             
     #break streams at snapped points
@@ -295,6 +295,18 @@ def breakstreams (conn):
             SELECT {appconfig.dbIdField},
                 st_split(st_snap(geometry, rawpnt, 0.001), rawpnt) as geometry
             FROM breakpoints 
+        ),
+        pieces as (
+            SELECT {appconfig.dbIdField},
+                st_geometryn(z.geometry, generate_series(1, st_numgeometries(z.geometry))) as geometry
+            FROM newlines z
+        ),
+        measures as (
+            SELECT z.{appconfig.dbIdField}, z.geometry,
+                st_linelocatepoint(y.geometry, st_startpoint(z.geometry)) as startmeasure,
+                st_linelocatepoint(y.geometry, st_endpoint(z.geometry)) as endmeasure
+            FROM pieces z JOIN {dbTargetSchema}.{dbTargetStreamTable} y 
+                ON y.{appconfig.dbIdField} = z.{appconfig.dbIdField}
         )
         
         SELECT z.{appconfig.dbIdField},
@@ -307,8 +319,10 @@ def breakstreams (conn):
                 {appconfig.streamTableChannelConfinementField},
                 {appconfig.streamTableDischargeField},
                 y.mainstem_id,
-                st_geometryn(z.geometry, generate_series(1, st_numgeometries(z.geometry))) as geometry
-        FROM newlines z JOIN {dbTargetSchema}.{dbTargetStreamTable} y 
+                z.geometry,
+                {subLine(f"y.{dbRawGeom}")} as {dbRawGeom},
+                {subLine(f"y.{dbTargetGeom}")} as {dbTargetGeom}
+        FROM measures z JOIN {dbTargetSchema}.{dbTargetStreamTable} y 
              ON y.{appconfig.dbIdField} = z.{appconfig.dbIdField};
         
         DELETE FROM {dbTargetSchema}.{dbTargetStreamTable} 
@@ -319,7 +333,7 @@ def breakstreams (conn):
             (id, source_id, {appconfig.dbWatershedIdField}, sec_code, sec_name, stream_name, strahler_order, 
             segment_length, w_segment_length,
             {appconfig.streamTableChannelConfinementField},{appconfig.streamTableDischargeField},
-            mainstem_id, geometry)
+            mainstem_id, geometry, {dbRawGeom}, {dbTargetGeom})
         SELECT gen_random_uuid(), a.source_id, a.{appconfig.dbWatershedIdField}, a.sec_code, a.sec_name,
             a.stream_name, a.strahler_order,
             st_length2d(a.geometry) / 1000.0, 
@@ -330,7 +344,7 @@ def breakstreams (conn):
             end,
             a.{appconfig.streamTableChannelConfinementField},
             a.{appconfig.streamTableDischargeField}, 
-            mainstem_id, a.geometry
+            mainstem_id, a.geometry, a.{dbRawGeom}, a.{dbTargetGeom}
         FROM {dbTargetSchema}.newstreamlines a;
 
         --UPDATE {dbTargetSchema}.{dbTargetStreamTable} set geometry = st_snaptogrid(geometry, 0.01);
@@ -359,8 +373,8 @@ def recomputeMainstreamMeasure(connection):
         ),
         measures AS (
             SELECT 
-                (st_linelocatepoint(b.geometry, st_startpoint(a.geometry)) * st_length(b.geometry)) / 1000.0 as startpct, 
-                (st_linelocatepoint(b.geometry, st_endpoint(a.geometry)) * st_length(b.geometry))  / 1000.0 as endpct,
+                (st_linelocatepoint(b.geometry, a.start_point) * st_length(b.geometry)) / 1000.0 as startpct, 
+                (st_linelocatepoint(b.geometry, a.end_point) * st_length(b.geometry))  / 1000.0 as endpct,
                 a.id
             FROM {dbTargetSchema}.{dbTargetStreamTable} a, mainstems b
             WHERE a.mainstem_id = b.mainstem_id
@@ -388,8 +402,7 @@ def updateBarrier(connection):
             SELECT a.id as stream_id, b.id as barrier_id
             FROM {dbTargetSchema}.{dbTargetStreamTable} a,
                 {dbTargetSchema}.{dbBarrierTable} b
-            WHERE st_dwithin(a.geometry, b.snapped_point, 0.01) and
-                st_dwithin(st_endpoint(a.geometry), b.snapped_point, 0.01)
+            WHERE st_dwithin(a.end_point, b.snapped_point, 0.01)
         )
         UPDATE {dbTargetSchema}.{dbBarrierTable}
             SET stream_id_up = a.stream_id
@@ -404,8 +417,7 @@ def updateBarrier(connection):
             SELECT a.id as stream_id, b.id as barrier_id
             FROM {dbTargetSchema}.{dbTargetStreamTable} a,
                 {dbTargetSchema}.{dbBarrierTable} b
-            WHERE st_dwithin(a.geometry, b.snapped_point, 0.01) and
-                st_dwithin(st_startpoint(a.geometry), b.snapped_point, 0.01)
+            WHERE st_dwithin(a.start_point, b.snapped_point, 0.01)
         )
         UPDATE {dbTargetSchema}.{dbBarrierTable}
             SET stream_id_down = a.stream_id
@@ -443,6 +455,8 @@ def main():
 
         print("    breaking streams at barrier points")
         breakstreams(connection)
+        stream_network.updateEndpoints(connection, dbTargetSchema, dbTargetStreamTable)
+        stream_network.invalidateNetwork(dbTargetSchema, dbTargetStreamTable)
         
         print("    recomputing mainstem measures")
         recomputeMainstreamMeasure(connection)
@@ -0,0 +1,163 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Helpers for writing processing results back to the database in bulk.
+#
+# DESCRIPTION
+#
+# Rows are streamed to the server with a binary COPY FROM STDIN into an
+# unlogged staging table and then applied to the target table with a
+# single UPDATE ... FROM statement, instead of running one UPDATE per row.
+#
+# Staging columns must be one of the types supported by copyRows (uuid,
+# integer, bigint, double precision, boolean, text, bytea). Geometries
+# are staged as WKB (bytea) and converted in the UPDATE, for example:
+#
+#   updateTable(conn, schema, table,
+#       [('id', 'uuid'), ('geometry', 'bytea')], rows,
+#       assign={'geometry': f'st_setsrid(st_geomfromwkb(s.geometry), {srid})'})
+#
+import io
+import struct
+import uuid
+
+_header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+
+def _uuid(value):
+    if (not isinstance(value, uuid.UUID)):
+        value = uuid.UUID(str(value))
+    return value.bytes
+
+def _text(value):
+    return str(value).encode('utf-8')
+
+def _bytea(value):
+    if (isinstance(value, str)):
+        return bytes.fromhex(value)
+    return bytes(value)
+
+_encoders = {
+    'uuid': _uuid,
+    'integer': lambda value: struct.pack('>i', int(value)),
+    'int4': lambda value: struct.pack('>i', int(value)),
+    'bigint': lambda value: struct.pack('>q', int(value)),
+    'int8': lambda value: struct.pack('>q', int(value)),
+    'double precision': lambda value: struct.pack('>d', float(value)),
+    'float8': lambda value: struct.pack('>d', float(value)),
+    'boolean': lambda value: struct.pack('>?', bool(value)),
+    'text': _text,
+    'varchar': _text,
+    'bytea': _bytea,
+}
+
+def _getEncoder(sqltype):
+    encoder = _encoders.get(sqltype.strip().lower())
+    if (encoder is None):
+        raise Exception(f"column type {sqltype} is not supported for bulk copy")
+    return encoder
+
+
+def copyRows(cursor, table, columns, rows):
+    """
+    Copies the rows into an existing table using binary COPY
+
+    :param cursor: database cursor
+    :param table: fully qualified table name
+    :param columns: list of (column name, sql type) tuples
+    :param rows: iterable of tuples with values in column order; None is
+       written as null
+    :return: number of rows copied
+    """
+    encoders = [_getEncoder(sqltype) for name, sqltype in columns]
+    fieldcount = struct.pack('>h', len(columns))
+    null = struct.pack('>i', -1)
+
+    data = io.BytesIO()
+    data.write(_header)
+    cnt = 0
+    for row in rows:
+        data.write(fieldcount)
+        for value, encoder in zip(row, encoders):
+            if (value is None):
+                data.write(null)
+                continue
+            value = encoder(value)
+            data.write(struct.pack('>i', len(value)))
+            data.write(value)
+        cnt += 1
+    data.write(struct.pack('>h', -1))
+    data.seek(0)
+
+    names = ",".join(name for name, sqltype in columns)
+    cursor.copy_expert(f"COPY {table} ({names}) FROM STDIN WITH (FORMAT binary)", data)
+    return cnt
+
+
+def createStagingTable(cursor, schema, name, columns):
+    """
+    (Re)creates an unlogged staging table with the given columns
+
+    :return: fully qualified table name
+    """
+    table = f"{schema}.{name}"
+    coldefs = ",".join(f"{colname} {sqltype}" for colname, sqltype in columns)
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS {table};
+        CREATE UNLOGGED TABLE {table} ({coldefs});
+    """)
+    return table
+
+
+def updateTable(connection, schema, table, columns, rows, assign = None):
+    """
+    Updates schema.table from the rows provided. The rows are copied into
+    an unlogged staging table and applied with a single UPDATE ... FROM.
+    The caller is responsible for committing the transaction.
+
+    :param connection: database connection
+    :param schema: schema of the table to update
+    :param table: table to update
+    :param columns: list of (column name, sql type) tuples; the first column
+       is the key used to match rows in the target table, the remaining
+       columns are updated
+    :param rows: iterable of tuples with values in column order
+    :param assign: optional dictionary of column name to sql expression
+       used to compute the new value from the staging table (alias s);
+       defaults to s.<column name>
+    :return: number of rows copied
+    """
+    if (assign is None):
+        assign = {}
+    key = columns[0][0]
+    sets = ",".join(f"{name} = {assign.get(name, 's.' + name)}" for name, sqltype in columns[1:])
+
+    with connection.cursor() as cursor:
+        staging = createStagingTable(cursor, schema, f"{table}_staging", columns)
+        cnt = copyRows(cursor, staging, columns, rows)
+        cursor.execute(f"""
+            ANALYZE {staging};
+
+            UPDATE {schema}.{table} t
+            SET {sets}
+            FROM {staging} s
+            WHERE t.{key} = s.{key};
+
+            DROP TABLE {staging};
+        """)
+    return cnt
@@ -24,6 +24,11 @@
 #
 # This is calculated as the difference between the current watershed DCI and the watershed DCI if the barrier was removed or made fully passable
 #
+# The dci of every stream segment is computed once for the current network. An inverted index from
+# each barrier to the stream segments that have that barrier downstream is then used so that, for
+# each barrier, only those segments are recalculated; the watershed DCI with the barrier removed is
+# the current total plus the change in those segments.
+#
 # A high DCI value for a barrier indicates a greater improvement to connectivity than a low DCI value.
 #
 # See: https://www.notion.so/cwf-spatial/Connectivity-Stats-14641376668e80f1bd72f1f701888a5f?source=copy_link#14641376668e80588a17fd2b333a7dcb
@@ -34,7 +39,11 @@
 import appconfig
 import psycopg2.extras
 import numpy as np
-import uuid
+
+try:
+    from processing_scripts import parallel
+except ModuleNotFoundError:
+    import parallel
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -45,20 +54,22 @@ dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 dbPassabilityTable = appconfig.config['BARRIER_PROCESSING']['passability_table']
 specCodes = appconfig.config[iniSection]['species']
 
+#number of worker processes used to compute barrier dci values; 0 uses all cpus
+dciWorkers = parallel.getWorkerCount(appconfig.config.getint('BARRIER_PROCESSING', 'dci_workers', fallback=1))
+
 class StreamData:
-    def __init__(self, fid, length, downbarriers, habitat):
-        self.fid = fid
+    """
+    Stream segment attributes stored as arrays in segment order
+    """
+    def __init__(self, fids, length, downbarriers, habitat):
+        self.fids = fids
         self.length = length
         self.downbarriers = downbarriers
         self.habitat = habitat
-        self.downpassability = {}
-        self.dci = {}
     
     def print(self):
-        print("fid:", self.fid)
-        print("downbarriers:", self.downbarriers)
-        print("downpassability:", self.downpassability)
-        print("habitat:", self.habitat)
+        print("streams:", len(self.fids))
+        print("habitat:", self.habitat.sum(axis=0))
 
 class BarrierData:
     def __init__(self, bid, passabilitystatus):
@@ -95,61 +106,187 @@ def getSpeciesConnectivity(conn, species):
 
     return dci_base
 
-def getBarrierDCI(barrier, barrierData, streamData, species, speciesDCI, totalHabitat):
+def buildBarrierIndex(streamData, barrierIndex, fish):
     """
-    Docstring for getBarrierDCI
-    
-    :param barrier: one barrier in the barrierData list
-    :param barrierData: List of BarrierData objects
-    :param streamData: List of StreamData objects
-    :param species: List of species codes
-    :param speciesDCI: Dict of dci per species for the entire stream network
-    :param totalHabitat: Dict of length of habitat per species over entire stream network
-    :return: dci for barrier
+    Builds an inverted index from each barrier to the stream segments that
+    have the barrier downstream (the segments whose dci changes if the
+    barrier is removed). The segments of barrier row b are
+    segments[ptr[b]:ptr[b+1]]; counts is the number of times the barrier
+    occurs in the downstream barriers of the segment.
+
+    :param streamData: StreamData object
+    :param barrierIndex: dict of barrier id (string) to barrier row
+    :param fish: species code
+    :return: (ptr, segments, counts, pairsegments, pairbarriers) where the
+        last two list every (segment, barrier row) pair including duplicates;
+        barriers not in barrierIndex have row -1
+    """
+    pairsegments = []
+    pairbarriers = []
+    for s, downbarriers in enumerate(streamData.downbarriers[fish]):
+        for b in (downbarriers or []):
+            pairsegments.append(s)
+            pairbarriers.append(barrierIndex.get(str(b), -1))
+    pairsegments = np.array(pairsegments, dtype=np.int64)
+    pairbarriers = np.array(pairbarriers, dtype=np.int64)
+
+    # unique (barrier, segment) pairs sorted by barrier
+    known = pairbarriers >= 0
+    keys = pairbarriers[known] * len(streamData.fids) + pairsegments[known]
+    keys, counts = np.unique(keys, return_counts=True)
+    barriers = keys // max(len(streamData.fids), 1)
+    segments = keys % max(len(streamData.fids), 1)
+
+    ptr = np.zeros(len(barrierIndex) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(barriers, minlength=len(barrierIndex)), out=ptr[1:])
+
+    return ptr, segments, counts, pairsegments, pairbarriers
+
+def getBarrierDCI(first, last, index, segmentData, passability):
     """
+    Computes the change in the network dci for the species when each
+    barrier in rows first to last is removed. Only the segments that have
+    the barrier downstream are recalculated; every other segment keeps
+    its baseline dci.
+
+    :param first: first barrier row
+    :param last: last barrier row (exclusive)
+    :param index: (ptr, segments, counts) inverted index from buildBarrierIndex
+    :param segmentData: (nonzeroprod, zerocnt, weight, segmentdci) per segment where
+        nonzeroprod and zerocnt describe the downstream passabilities, weight is
+        the dci of the segment if it were fully connected and segmentdci is the
+        baseline dci of the segment
+    :param passability: array of barrier passability for the species
+    :return: array of the dci change for each barrier in first to last
+    """
+    ptr, segments, counts = index
+    nonzeroprod, zerocnt, weight, segmentdci = segmentData
+
+    start = ptr[first]
+    end = ptr[last]
+    segments = segments[start:end]
+    counts = counts[start:end]
+    barriers = np.repeat(np.arange(first, last), np.diff(ptr[first:last + 1]))
+
+    # downstream passability of each segment excluding the barrier
+    p = passability[barriers]
+    newprod = np.zeros(len(segments), dtype=np.float64)
+    passable = p != 0
+    nozero = passable & (zerocnt[segments] == 0)
+    newprod[nozero] = nonzeroprod[segments[nozero]] / (p[nozero] ** counts[nozero])
+    onlyzero = ~passable & (zerocnt[segments] == counts)
+    newprod[onlyzero] = nonzeroprod[segments[onlyzero]]
+
+    delta = weight[segments] * newprod - segmentdci[segments]
+    return np.bincount(barriers - first, weights=delta, minlength=last - first)
+
+def getBarrierDCIChunk(task):
+    """
+    Computes getBarrierDCI for a chunk of barriers using the arrays
+    shared for the species
 
-    newStreamArray = []
-    dci_sum = {}
-
-    # TODO: This loop is not a significant bottleneck, nor is the DCI used that much by the biologists
-    # However, this could probably be improved using dynamic programming. 
-    # The DCI values for every stream segment in the entire network should not need to be recalculated every time we want to get the dci for one barrier
-    # Rather, we should keep a table of each stream segment's dci and populate it initially with the dci of the network
-    # Then, when we want to find the dci for a barrier, we should find only the stream segments with that barrier id as a downbarrier and only recalculate those
-    # Then sum the dci's for the stream network using a combination of the previously calculated dcis and the new dcis
-    for stream in streamData:
-        streamDCI = {}
-        downbarriers = stream.downbarriers
-        downpassability = stream.downpassability
-        newStreamData = StreamData(stream.fid, stream.length, downbarriers, stream.habitat)         # This will store the stream info if barrier were removed
+    :param task: (species code, first barrier row, last barrier row)
+    :return: array of the dci change for each barrier in the chunk
+    """
+    fish, first, last = task
+    arrays = parallel.shared
 
-        for fish in species:
-            downbarriers[fish] = stream.downbarriers[fish]
-            passabilities = []
-            
-            for b in downbarriers[fish]:                # passability values for downstream barriers aside from current barrier
-                if str(b) == str(barrier.bid):
-                    pass
-                else:
-                    passabilities.append(barrierData[uuid.UUID(b)].passabilitystatus[fish])
-            
-            downpassability[fish] = np.prod(passabilities)
-            newStreamData.downpassability[fish] = downpassability[fish]
+    index = (arrays[fish + '.ptr'], arrays[fish + '.segments'], arrays[fish + '.counts'])
+    segmentData = (arrays[fish + '.nonzeroprod'], arrays[fish + '.zerocnt'],
+        arrays[fish + '.weight'], arrays[fish + '.segmentdci'])
 
-            if newStreamData.habitat[fish]:
-                streamDCI[fish] = ((newStreamData.length / totalHabitat[fish]) * newStreamData.downpassability[fish]) * 100  # DCI calculation for stream segment
-            else:
-                streamDCI[fish] = 0
-            
-            newStreamData.dci[fish] = streamDCI[fish]
-            
-        newStreamArray.append(newStreamData) # list of dci for each stream segment 
+    return getBarrierDCI(first, last, index, segmentData, arrays[fish + '.passability'])
+
+def getSegmentData(streamData, pairs, passability, s, totalHabitat):
+    """
+    Computes the baseline dci of every stream segment for the species
     
-    for fish in species:
-        dci_sum[fish] = sum(newStream.dci[fish] for newStream in newStreamArray)
-        barrier.dci[fish] = round((dci_sum[fish] - speciesDCI[fish]),4)
+    :param streamData: StreamData object
+    :param pairs: (pairsegments, pairbarriers) from buildBarrierIndex
+    :param passability: array of barrier passability for the species
+    :param s: species column
+    :param totalHabitat: length of habitat for the species over the entire stream network
+    :return: (nonzeroprod, zerocnt, weight, segmentdci)
+    """
+    pairsegments, pairbarriers = pairs
+    streamcnt = len(streamData.fids)
+
+    # barriers not in the barrier table are impassable
+    p = np.zeros(len(pairbarriers), dtype=np.float64)
+    known = pairbarriers >= 0
+    p[known] = passability[pairbarriers[known]]
+
+    nonzeroprod = np.ones(streamcnt, dtype=np.float64)
+    np.multiply.at(nonzeroprod, pairsegments[p != 0], p[p != 0])
+    zerocnt = np.bincount(pairsegments[p == 0], minlength=streamcnt)
 
-    return barrier.dci
+    habitat = streamData.habitat[:, s]
+    weight = np.zeros(streamcnt, dtype=np.float64)
+    if (totalHabitat):
+        weight[habitat] = (streamData.length[habitat] / totalHabitat) * 100
+
+    segmentdci = np.where(zerocnt == 0, weight * nonzeroprod, 0.0)
+
+    return nonzeroprod, zerocnt, weight, segmentdci
+
+def computeBarrierDCI(barrierData, streamData, species, speciesDCI, totalHabitat):
+    """
+    Computes the dci of every barrier as the difference between the network
+    dci with the barrier removed and the current network dci. The network dci
+    with the barrier removed is the baseline dci of all segments plus the
+    change in dci of the segments upstream of the barrier.
+
+    :param barrierData: dict of barrier id to BarrierData
+    :param streamData: StreamData object
+    :param species: list of species codes
+    :param speciesDCI: Dict of dci per species for the entire stream network
+    :param totalHabitat: Dict of length of habitat per species over entire stream network
+    :return: list of BarrierData objects with dci assigned
+    """
+    barrierIds = list(barrierData.keys())
+    barrierIndex = {str(bid): b for b, bid in enumerate(barrierIds)}
+    dci = np.zeros((len(barrierIds), len(species)), dtype=np.float64)
+
+    # barriers are split into chunks that are computed in parallel
+    # across all species
+    chunksize = max(1, -(-len(barrierIds) // (dciWorkers * 4)))
+    tasks = []
+    networkdci = {}
+
+    for s, fish in enumerate(species):
+        print("  building barrier index for", fish)
+        passability = np.array([barrierData[bid].passabilitystatus[fish] for bid in barrierIds], dtype=np.float64)
+
+        ptr, segments, counts, pairsegments, pairbarriers = buildBarrierIndex(streamData, barrierIndex, fish)
+        segmentData = getSegmentData(streamData, (pairsegments, pairbarriers), passability, s, totalHabitat[fish])
+        networkdci[fish] = segmentData[3].sum()
+
+        parallel.share({
+            fish + '.ptr': ptr, fish + '.segments': segments, fish + '.counts': counts,
+            fish + '.nonzeroprod': segmentData[0], fish + '.zerocnt': segmentData[1],
+            fish + '.weight': segmentData[2], fish + '.segmentdci': segmentData[3],
+            fish + '.passability': passability}, dciWorkers)
+
+        for first in range(0, len(barrierIds), chunksize):
+            tasks.append((fish, first, min(first + chunksize, len(barrierIds))))
+
+    print("  computing barrier dci using", dciWorkers, "worker(s)")
+    try:
+        results = parallel.mapTasks(getBarrierDCIChunk, tasks, dciWorkers)
+    finally:
+        parallel.release()
+
+    for (fish, first, last), deltas in zip(tasks, results):
+        dci[first:last, species.index(fish)] = networkdci[fish] + deltas - speciesDCI[fish]
+
+    newAllBarrierData = []
+    for b, bid in enumerate(barrierIds):
+        newBarrierData = BarrierData(bid, barrierData[bid].passabilitystatus)
+        for s, fish in enumerate(species):
+            newBarrierData.dci[fish] = round(float(dci[b, s]), 4)
+        newAllBarrierData.append(newBarrierData)
+
+    return newAllBarrierData
 
 def getHabitatLength(conn, species):
 
@@ -168,19 +305,17 @@ def getHabitatLength(conn, species):
 
 def generateStreamData(conn, species):
     """
-    Generates an array of StreamData objects over entire stream network. Each StreamData object is a stream segment with the following attributes:
-    fid             - id of stream segment
-    length          - length of stream segment
-    downbarriers    - a dictionary containing arrays of downstream barrier ids per species from that stream segment
-    habitat         - dict containing each species and a boolean indicating whether the stream segment is habitat for that species
+    Generates a StreamData object over entire stream network with the following attributes:
+    fids            - list of ids of stream segments
+    length          - array of length of each stream segment
+    downbarriers    - a dictionary containing, per species, a list with the downstream barrier ids of each stream segment
+    habitat         - (segments, species) boolean array indicating whether the stream segment is habitat for that species
     
     :param conn: db conenciton
     :param species: array of species
-    :return: Array of StreamData objects
+    :return: StreamData object
     """
 
-    streamArray = []
-
     barrierdownmodel = ''
     habitatmodel = ''
 
@@ -199,24 +334,20 @@ def generateStreamData(conn, species):
     with conn.cursor() as cursor:
         cursor.execute(query)
         allstreamdata = cursor.fetchall()
-        
-        for stream in allstreamdata:
 
-            fid = stream[0]
-            length = stream[1]
-            downbarriers = {}
-            habitat = {}
+    fids = [stream[0] for stream in allstreamdata]
+    length = np.array([0 if stream[1] is None else stream[1] for stream in allstreamdata], dtype=np.float64)
+    downbarriers = {}
+    habitat = np.zeros((len(allstreamdata), len(species)), dtype=bool)
 
-            index = 2
+    index = 2
 
-            for fish in species:
-                downbarriers[fish] = stream[index]
-                habitat[fish] = stream[index + len(species)]
-                index = index + 1
-            
-            streamArray.append(StreamData(fid, length, downbarriers, habitat))
+    for s, fish in enumerate(species):
+        downbarriers[fish] = [stream[index] for stream in allstreamdata]
+        habitat[:, s] = [bool(stream[index + len(species)]) for stream in allstreamdata]
+        index = index + 1
 
-    return streamArray
+    return StreamData(fids, length, downbarriers, habitat)
 
 def generateBarrierData(conn, species):
     """
@@ -399,14 +530,7 @@ def main():
 
         barrierData = generateBarrierData(conn, species)
 
-        newAllBarrierData = []
-
-        for barrierid in barrierData:
-            print("barrier id:", barrierid, "object:", barrierData[barrierid])
-            dci = getBarrierDCI(barrierData[barrierid], barrierData, streamData, species, speciesDCI, totalHabitat)
-            newBarrierData = BarrierData(barrierData[barrierid].bid, barrierData[barrierid].passabilitystatus)
-            newBarrierData.dci = dci
-            newAllBarrierData.append(newBarrierData)
+        newAllBarrierData = computeBarrierDCI(barrierData, streamData, species, speciesDCI, totalHabitat)
 
         writeResults(conn, newAllBarrierData, species)
 
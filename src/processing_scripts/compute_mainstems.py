@@ -29,10 +29,15 @@
 #  * elevation processing is completed
 #
 import appconfig
-import shapely.wkb
-from collections import deque
 import uuid
-import psycopg2.extras
+import numpy as np
+
+try:
+    from processing_scripts import stream_network
+    from processing_scripts import bulk_update
+except ModuleNotFoundError:
+    import stream_network
+    import bulk_update
 
 iniSection = appconfig.args.args[0]
 
@@ -43,214 +48,143 @@ dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
 dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
 dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
-edges = []
-nodes = dict()
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.uplength = 0
-        self.upedge = None
-        self.mainstemid = None
-        self.downstreammeasure = 0
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, length, sname, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.length = length
-        self.sname = sname
-        self.mainstemid = None
-        self.uplength = 0
-        self.downstreammeasure = 0
-        
+network = None
+
+#per edge values in network edge order
+snames = []
+edgemainstemid = []
+edgedownstreammeasure = None
+
+#per node values
+nodeuplength = None
+nodemainstemid = []
+nodedownstreammeasure = None
+
 def createNetwork(connection):
+    global network
+
+    network = stream_network.getNetwork(connection, dbTargetSchema, dbTargetStreamTable)
 
     query = f"""
-        SELECT a.{appconfig.dbIdField} as id, st_length(a.{appconfig.dbGeomField}) as length, 
-          a.stream_name, a.{appconfig.dbGeomField}
+        SELECT a.{appconfig.dbIdField} as id, a.stream_name
         FROM {dbTargetSchema}.{dbTargetStreamTable} a
     """
-   
-    #load geometries and create a network
+
+    #load stream names for the network edges
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
-        
-        for feature in features:
-            fid = feature[0]
-            length = feature[1]
-            sname = feature[2]
-            if (sname == "UNNAMED"):
-                sname = None
-                
-            geom = shapely.wkb.loads(feature[3], hex=True)
 
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, length, sname, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
+    index = network.indexOf([feature[0] for feature in features])
+
+    snames.clear()
+    snames.extend([None] * network.edgeCount)
+    for feature, edge in zip(features, index):
+        sname = feature[1]
+        if (sname == "UNNAMED"):
+            sname = None
+        snames[edge] = sname
 
 def processNodes():
+    global nodeuplength, nodedownstreammeasure, edgedownstreammeasure
+
+    length = network.length
+
+    #walk down network computing the longest upstream length at each node
+    edgeuplength, nodeuplength = network.accumulateDownstream(length, aggregate=np.maximum)
 
-    #walk down network   
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        
-        maxValue = 0 
-        for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False
-                break
-            else:
-                length = inedge.fromNode.uplength + inedge.length
-                if (length > maxValue):
-                    maxValue = length
-        
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            node.uplength = maxValue
-            
-        for outedge in node.outedges:
-            outedge.visited = True
-            if (not outedge.toNode in toprocess):
-                toprocess.append(outedge.toNode)
-    
     #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-            node.mainstemid = uuid.uuid4()
-    
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        if (len(node.inedges) == 0):
-            continue
-        
+    outdegree = network.getOutDegree()
+
+    edgemainstemid.clear()
+    edgemainstemid.extend([None] * network.edgeCount)
+    edgedownstreammeasure = np.zeros(network.edgeCount, dtype=np.float64)
+
+    nodemainstemid.clear()
+    nodemainstemid.extend([None] * network.nodeCount)
+    nodedownstreammeasure = np.zeros(network.nodeCount, dtype=np.float64)
+
+    for node in np.flatnonzero(outdegree == 0):
+        nodemainstemid[node] = uuid.uuid4()
+
+    def visit(node):
+        inedges = network.getInEdges(node)
+        if (len(inedges) == 0):
+            return
+
         #visit this node
         sname = None
-        if (len(node.outedges) > 0):
-            sname = node.outedges[0].sname
-        
+        if (outdegree[node] > 0):
+            sname = snames[network.getOutEdges(node)[0]]
+
         longest = -9999
         longestNode = None
-        
+
         namedNode = None
-        
+
         longestnamed = -9999
         longestnamedNode = None
-        
-        for inedge in node.inedges:
-            if (inedge.fromNode.uplength + inedge.length > longest):
-                longest = inedge.fromNode.uplength + inedge.length
-                longestNode = inedge.fromNode
-            
-            if (sname != None and inedge.sname == sname):
-                namedNode = inedge.fromNode
-            
-            if (inedge.sname != None and (sname != None and inedge.sname != sname)):
-                if (inedge.fromNode.uplength > longestnamed):
-                    longestnamed = inedge.fromNode.uplength
-                    longestnamedNode = inedge.fromNode
-                    
+
+        for inedge in inedges:
+            fromnode = network.fromNode[inedge]
+            if (nodeuplength[fromnode] + length[inedge] > longest):
+                longest = nodeuplength[fromnode] + length[inedge]
+                longestNode = fromnode
+
+            if (sname != None and snames[inedge] == sname):
+                namedNode = fromnode
+
+            if (snames[inedge] != None and (sname != None and snames[inedge] != sname)):
+                if (nodeuplength[fromnode] > longestnamed):
+                    longestnamed = nodeuplength[fromnode]
+                    longestnamedNode = fromnode
+
         upnode = None
         if (namedNode != None):
             upnode = namedNode
         elif (longestnamedNode != None):
             upnode = longestnamedNode
         elif (longestNode != None):
-            upnode = longestNode 
-        
-        for inedge in node.inedges:
-            if (inedge.fromNode == upnode):
-                inedge.mainstemid = node.mainstemid
-                inedge.fromNode.downstreammeasure = node.downstreammeasure + inedge.length
-                inedge.downstreammeasure = node.downstreammeasure
+            upnode = longestNode
+
+        for inedge in inedges:
+            fromnode = network.fromNode[inedge]
+            if (fromnode == upnode):
+                edgemainstemid[inedge] = nodemainstemid[node]
+                nodedownstreammeasure[fromnode] = nodedownstreammeasure[node] + length[inedge]
+                edgedownstreammeasure[inedge] = nodedownstreammeasure[node]
             else:
-                inedge.mainstemid = uuid.uuid4()
-                inedge.downstreammeasure = 0
-                inedge.fromNode.downstreammeasure = inedge.length
+                edgemainstemid[inedge] = uuid.uuid4()
+                edgedownstreammeasure[inedge] = 0
+                nodedownstreammeasure[fromnode] = length[inedge]
+
+            nodemainstemid[fromnode] = edgemainstemid[inedge]
+
+    network.walkUpstream(visit)
+
 
-            inedge.fromNode.mainstemid = inedge.mainstemid
-            
-            toprocess.append(inedge.fromNode)
-    
-        
 def writeResults(connection):
-      
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-        SET {dbMainstemField} = %s, {dbDownMeasureField} = %s, {dbUpMeasureField} = %s
-        WHERE {appconfig.dbIdField} = %s;
-    """
     
     newdata = []
     
-    for edge in edges:
-        downmeasurekm = (edge.downstreammeasure)
-        upmeasurekm = (edge.downstreammeasure + edge.length)
-        newdata.append( (edge.mainstemid, downmeasurekm, upmeasurekm, edge.fid) )
+    for edge in range(network.edgeCount):
+        downmeasurekm = float(edgedownstreammeasure[edge])
+        upmeasurekm = float(edgedownstreammeasure[edge] + network.length[edge])
+        newdata.append( (network.getFid(edge), edgemainstemid[edge], downmeasurekm, upmeasurekm) )
     
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata)
+    columns = [(appconfig.dbIdField, 'uuid'), (dbMainstemField, 'uuid'),
+               (dbDownMeasureField, 'double precision'), (dbUpMeasureField, 'double precision')]
+    bulk_update.updateTable(connection, dbTargetSchema, dbTargetStreamTable, columns, newdata)
             
     connection.commit()
 
 
 #--- main program ---  
 def main():  
-    edges.clear()
-    nodes.clear()
+    snames.clear()
+    edgemainstemid.clear()
+    nodemainstemid.clear()
     
     with appconfig.connectdb() as conn:
         
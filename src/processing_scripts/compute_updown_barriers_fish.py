@@ -22,27 +22,29 @@
 # DESCRIPTION
 # 
 # 1.	Build a network graph structure: 
-# -	Reads all stream segments from the database
-# -	Creates nodes and edges forming a connected network
-# -	Each edge stores its geometry, database ID, and sets to hold barrier information
+# -	Uses the shared stream network (stream_network.py) built from the stream segments in the database
+# -	Nodes and edges form a connected network
+# -	Barrier ids are interned to integers; the barriers up and downstream of the edges are stored as
+#   chains of shared entries (stream_network.ReachSets) created only at barrier nodes and confluences
 # -	Each node can have multiple incoming edges (tributaries) and outgoing edges (downstream connections)
 # 2.	Add barriers to the network: 
-# -	Queries for regular barriers (dams, assessed crossings) that are impassable for the current species
-# -	Identifies whether each barrier sits at the upstream end (start point) or downstream end (end point) of a stream segment
-# -	Stores barrier IDs in the appropriate nodes
+# -	Queries for regular barriers (dams, assessed crossings) that are impassable for each species
+# -	Identifies the network nodes (stream start and end points) within 0.01 of each barrier using a grid
+#   hash of the node coordinates
+# -	Stores barriers in the appropriate nodes
 # -	Separately queries for gradient barriers (steep sections, waterfalls) using the same logic
 # -	Only considers barriers where passability_status != 1 (not quite passable) for the specific fish species
 # 3.	Traverse downstream (headwaters to outlet): 
-# -	Uses a queue-based algorithm starting from headwater nodes (those with no incoming edges)
-# -	For each node, waits until all upstream edges have been visited to maintain order
+# -	Walks the nodes in topological order starting from headwater nodes (those with no incoming edges)
+# -	Each node is visited once, after all upstream edges have been visited
 # -	Collects all barriers found upstream by: 
 #   -	Combining barriers from all incoming tributary edges
 #   -	Adding any barriers located at this node itself
 # -	Propagates this cumulative set of upstream barriers to all outgoing (downstream) edges
 # -	Continues until all edges know their complete set of upstream barriers
 # 4.	Traverse upstream (outlet to headwaters): 
-# -	Uses a queue-based algorithm starting from outlet nodes (those with no outgoing edges)
-# -	For each node, waits until all downstream edges have been visited
+# -	Walks the nodes in reverse topological order starting from outlet nodes (those with no outgoing edges)
+# -	Each node is visited once, after all downstream edges have been visited
 # -	Collects all barriers found downstream by: 
 #   -	Combining barriers from all outgoing edges
 #   -	Adding any barriers located at this node itself
@@ -56,16 +58,21 @@
 #   -	Array of downstream barrier IDs
 #   -	Count of upstream gradient barriers
 #   -	Count of downstream gradient barriers
-# 6.	Repeat for all species: 
-# -	Clears the network and rebuilds it for each fish species
+# 6.	All species are processed together: 
+# -	The network is built and traversed once with the barriers of all species; each barrier has a
+#   per species passability mask that selects the barriers of each species when the results are written
 # -	This is necessary because the same physical barrier might be passable for one species but impassable for another
 # -	Creates separate columns for each species (for example: barrier_up_as_cnt for Atlantic Salmon)
 
 #
 import appconfig
-import shapely.wkb
-from collections import deque
 import psycopg2.extras
+import numpy as np
+
+try:
+    from processing_scripts import stream_network
+except ModuleNotFoundError:
+    import stream_network
 
 
 iniSection = appconfig.args.args[0]
@@ -81,300 +88,164 @@ dbPassabiltyTable = appconfig.config['BARRIER_PROCESSING']['passability_table']
 snapDistance = appconfig.config['CABD_DATABASE']['snap_distance']
 species = appconfig.config[iniSection]['species']
 
-edges = []
-nodes = dict()
+network = None
 
-# with appconfig.connectdb() as conn:
+#species codes processed
+specCodes = []
 
-#     query = f"""
-#     SELECT code, name
-#     FROM {dataSchema}.{appconfig.fishSpeciesTable};
-#     """
+#barrier ids are interned to dense integers; barrier i is barrierids[i]
+barrierids = []
+gradientbarrierids = []
 
-#     with conn.cursor() as cursor:
-#         cursor.execute(query)
-#         specCodes = cursor.fetchall()
+#(species, barriers) boolean arrays; true where the barrier
+#is impassable for the species
+barriermask = None
+gradientbarriermask = None
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.barrierids = set()
-        self.gradientbarrierids = set()
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-   
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.upbarriers = set()
-        self.downbarriers = set()
-        self.upgradient = set()
-        self.downgradient = set()
-        
-def createNetwork(connection, code): 
-    # Currenty the queries take very long to run could see if this can be improved in the future
-    
-    query = f"""
-        SELECT a.{appconfig.dbIdField} as id, a.{appconfig.dbGeomField}
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            fid = feature[0]
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)     
-            
-    #add barriers
-    # query = f"""
-    #     select 'up', a.id, b.id
-    #     from {dbTargetSchema}.{dbBarrierTable} a, {dbTargetSchema}.{dbTargetStreamTable} b
-    #     where st_dwithin(b.geometry, a.snapped_point, 0.01)
-    #         and st_dwithin(st_startpoint(b.geometry), a.snapped_point, 0.01)
-    #         and a.passability_status_{code} != 1
-    #     union 
-    #     select 'down', a.id, b.id 
-    #     from {dbTargetSchema}.{dbBarrierTable} a, {dbTargetSchema}.{dbTargetStreamTable} b
-    #     where st_dwithin(b.geometry, a.snapped_point, 0.01)
-    #         and st_dwithin(st_endpoint(b.geometry), a.snapped_point, 0.01)
-    #         and a.passability_status_{code} != 1
-    # """
+#(nodes, barriers) arrays of the barriers at each node
+nodebarriers = None
+nodegradientbarriers = None
+
+#barriers (of all species) up and downstream of each edge
+#(see stream_network.ReachSets)
+upbarriers = None
+downbarriers = None
+upgradient = None
+downgradient = None
+
+def createNetwork(connection): 
+    global network, nodebarriers, nodegradientbarriers, barriermask, gradientbarriermask
+
+    network = stream_network.getNetwork(connection, dbTargetSchema, dbTargetStreamTable)
+
+    if len(specCodes) == 1:
+        codes = f"('{specCodes[0]}')"
+    else:
+        codes = tuple(specCodes)
 
     #add barriers
     query = f"""
-        select 'up', a.id, b.id
+        select a.id, st_x(a.snapped_point), st_y(a.snapped_point), f.code
         from {dbTargetSchema}.{dbBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.snapped_point, 0.01)
-            and st_dwithin(st_startpoint(b.geometry), a.snapped_point, 0.01)
-            and f.code = '{code}'
-            and p.passability_status != '1'
-        union 
-        select 'down', a.id, b.id 
-        from {dbTargetSchema}.{dbBarrierTable} a
-        join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.snapped_point, 0.01)
-            and st_dwithin(st_endpoint(b.geometry), a.snapped_point, 0.01)
-            and f.code = '{code}'
+        join {dbTargetSchema}.fish_species f on p.species_id = f.id
+        where f.code IN {codes}
             and p.passability_status != '1'
     """
    
-    #load geometries and create a network
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
-        
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.barrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.barrierids.add(bid)
+
+    nodebarriers, barriermask = attachBarriers(features, barrierids)
                         
     #add gradient barriers
     query = f"""
-        select 'up', a.id, b.id 
-        from {dbTargetSchema}.{dbGradientBarrierTable} a
-        join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.point, 0.01)
-            and st_dwithin(st_startpoint(b.geometry), a.point, 0.01)
-            and (a.type = 'gradient_barrier' or a.type = 'waterfall')
-            and f.code = '{code}'
-            and p.passability_status != '1'
-        union 
-        select 'down', a.id, b.id 
+        select a.id, st_x(a.point), st_y(a.point), f.code
         from {dbTargetSchema}.{dbGradientBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
-        join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
-        {dbTargetSchema}.{dbTargetStreamTable} b
-        where st_dwithin(b.geometry, a.point, 0.01)
-            and st_dwithin(st_endpoint(b.geometry), a.point, 0.01)
-            and (a.type = 'gradient_barrier' or a.type = 'waterfall')
-            and f.code = '{code}'
+        join {dbTargetSchema}.fish_species f on p.species_id = f.id
+        where (a.type = 'gradient_barrier' or a.type = 'waterfall')
+            and f.code IN {codes}
             and p.passability_status != '1'
     """
    
-    #load geometries and create a network
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
-        
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.gradientbarrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.gradientbarrierids.add(bid)         
+
+    nodegradientbarriers, gradientbarriermask = attachBarriers(features, gradientbarrierids)
+
+def attachBarriers(features, ids):
+    """
+    Interns the barrier ids and returns the barriers at each node. A 
+    barrier is at a node if it is within 0.01 of the node (the start or
+    end point of a stream). The barriers are shared by all species; the
+    species each barrier applies to are returned as a mask.
+
+    :param features: (barrier id, x, y, species code) rows
+    :param ids: list that is filled with the barrier id of each interned barrier
+    :return: ((nodes, barriers), mask); arrays of the barriers at each node
+        and a (species, barriers) boolean array that is true where the 
+        barrier is impassable for the species
+    """
+    ids.clear()
+    features = [feature for feature in features if feature[1] is not None and feature[3] in specCodes]
+
+    idindex = {}
+    barriers = []
+    for feature in features:
+        if (feature[0] not in idindex):
+            idindex[feature[0]] = len(ids)
+            ids.append(feature[0])
+        barriers.append(idindex[feature[0]])
+
+    x = [feature[1] for feature in features]
+    y = [feature[2] for feature in features]
+    codes = np.array([specCodes.index(feature[3]) for feature in features], dtype=np.int64)
+    barriers = np.array(barriers, dtype=np.int64)
+
+    mask = np.zeros((len(specCodes), len(ids)), dtype=bool)
+    mask[codes, barriers] = True
+
+    points, nodes = network.findNodes(x, y, 0.01)
+    return (nodes, barriers[points]), mask
 
 def processNodes():
-    
-    
-    #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        
-        upbarriers = set()
-        upgradient = set()
-         
-        for inedge in node.inedges:
-               
-            if not inedge.visited:
-                allvisited = False
-                break
-            else:
-                upbarriers.update(inedge.upbarriers)
-                upgradient.update(inedge.upgradient)
-                
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            upbarriers.update(node.barrierids)
-            upgradient.update(node.gradientbarrierids)
-        
-            for outedge in node.outedges:
-                outedge.upbarriers.update(upbarriers)
-                outedge.upgradient.update(upgradient)
-                
-                outedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(outedge.toNode)
-            
-            
-    #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-    
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        if (len(node.inedges) == 0):
-            continue
-        
-        downbarriers = set()
-        downbarriers.update(node.barrierids)
+    global upbarriers, downbarriers, upgradient, downgradient
 
-        downgradient = set()
-        downgradient.update(node.gradientbarrierids)
-        
-        allvisited = True
-        
-        for outedge in node.outedges:
-            if not outedge.visited:
-                allvisited = False
-                break
-            else:
-                downbarriers.update(outedge.downbarriers)
-                downgradient.update(outedge.downgradient)
-
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            for inedge in node.inedges:
-                inedge.downbarriers.update(downbarriers)
-                inedge.downgradient.update(downgradient)             
-                inedge.visited = True
-                if (not inedge.toNode in toprocess):
-                    toprocess.append(inedge.fromNode)
+    #walk down network; the upstream barriers of an edge are the barriers
+    #at its from node plus the upstream barriers of all edges into that node
+    upbarriers = network.reachDownstream(*nodebarriers)
+    upgradient = network.reachDownstream(*nodegradientbarriers)
+
+    #walk up network; the downstream barriers of an edge are the barriers
+    #at its to node plus the downstream barriers of all edges out of that node
+    downbarriers = network.reachUpstream(*nodebarriers)
+    downgradient = network.reachUpstream(*nodegradientbarriers)
     
         
-def writeResults(connection, code):
-      
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetStreamTable} SET 
+def writeResults(connection):
+
+    setstr = ''
+    for code in specCodes:
+        setstr = setstr + f"""
             barrier_up_{code}_cnt = %s,
             barrier_down_{code}_cnt = %s,
             barriers_up_{code} = %s,
             barriers_down_{code} = %s,
             gradient_barrier_up_{code}_cnt = %s,
-            gradient_barrier_down_{code}_cnt = %s
+            gradient_barrier_down_{code}_cnt = %s,"""
+      
+    updatequery = f"""
+        UPDATE {dbTargetSchema}.{dbTargetStreamTable} SET {setstr[:-1]}
             
         WHERE id = %s;
     """
     
     newdata = []
-    
-    for edge in edges:
-        upbarriersstr = (list(edge.upbarriers),)  
-        downbarriersstr = (list(edge.downbarriers),)
+
+    #barrier id arrays are only created when writing; the barriers
+    #of each species are selected with the species mask
+    for edge in range(network.edgeCount):
+        up = upbarriers.getItems(edge)
+        down = downbarriers.getItems(edge)
+        upgradientitems = upgradient.getItems(edge)
+        downgradientitems = downgradient.getItems(edge)
         
-        newdata.append( (len(edge.upbarriers), len(edge.downbarriers), upbarriersstr, downbarriersstr, len(edge.upgradient), len(edge.downgradient), edge.fid))
+        data = []
+        for s in range(len(specCodes)):
+            speciesup = up[barriermask[s, up]]
+            speciesdown = down[barriermask[s, down]]
+            upbarriersstr = ([barrierids[i] for i in speciesup.tolist()],)
+            downbarriersstr = ([barrierids[i] for i in speciesdown.tolist()],)
+
+            data.extend([len(speciesup), len(speciesdown), upbarriersstr, downbarriersstr, 
+                int(gradientbarriermask[s, upgradientitems].sum()), 
+                int(gradientbarriermask[s, downgradientitems].sum())])
+        
+        data.append(network.getFid(edge))
+        newdata.append(tuple(data))
 
     
     with connection.cursor() as cursor:    
@@ -390,32 +261,14 @@ def main():
 
         conn.autocommit = False
 
-        # query = f"""
-        # SELECT code, name
-        # FROM {dataSchema}.{appconfig.fishSpeciesTable};
-        # """
-
-        global specCodes
-        global species
-
-        specCodes = [substring.strip() for substring in species.split(',')]
-
-        # with conn.cursor() as cursor:
-        #     cursor.execute(query)
-        #     specCodes = cursor.fetchall()
+        specCodes.clear()
+        specCodes.extend([substring.strip() for substring in species.split(',')])
 
-        for species in specCodes:
-            code = species
-            # name = species[1]
-        
-            
+        print("Computing Upstream/Downstream Barriers")
+        print("  processing barriers for", ", ".join(specCodes))
+        print("  creating output columns")
 
-            edges.clear()
-            nodes.clear()
-            
-            print("Computing Upstream/Downstream Barriers")
-            print("  processing barriers for", code)
-            print("  creating output column")
+        for code in specCodes:
 
             query = f"""
                 ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barrier_up_{code}_cnt;
@@ -439,16 +292,16 @@ def main():
             with conn.cursor() as cursor:
                 cursor.execute(query)
             
-            print("  creating network")
-            createNetwork(conn, code)
+        print("  creating network")
+        createNetwork(conn)
+        
+        print("  processing nodes")
+        processNodes()
             
-            print("  processing nodes")
-            processNodes()
-                
-            print("  writing results")
-            writeResults(conn, code)
+        print("  writing results")
+        writeResults(conn)
         
     print("done")
     
 if __name__ == "__main__":
-    main()      
\ No newline at end of file
+    main()
@@ -27,11 +27,32 @@
 #DESCRIPTION
 # This Python script calculates stream gradients for a river network using DEM data. The resulting table contains gradient information for vertices (points) along the stream network, including elevations, calculated gradients, and gradient classifications. The script works in four main steps.
 # 1.	Prepare the geometry: Takes 3D stream data (x, y, and z values) and adds distance measurements along each stream segment, creating a 4D geometry (x, y, z, and distance).
-# 2.	Calculate vertex gradients: For each point along the stream segments, it measures the elevation change over a 100-meter distance upstream. This gives the gradient at that location. Additionally, it also computes the maximum vertex gradient for each 100-meter section.
+# 2.	Calculate vertex gradients: For each point along the stream segments, it measures the elevation change over a 100-meter (gradient_windows) distance upstream. This gives the gradient at that location. Additionally, it also computes the maximum vertex gradient for each 100-meter section.
 # 3.	Classify gradients: Groups each gradient into categories based on steepness—for example, slopes between 5-7%, 7-10%, 10-12%, and so on. Once the gradients reach >30%, they are assigned different grade classes.
 # 4.	Clean up: Removes any invalid elevation data (like -999999, which appears to be a placeholder for missing values) and stores the results in a new table.
+#
+# By default (vertex_gradient_method = numpy) the gradients are computed in Python: the smoothed
+# vertices of every stream on a mainstem are read once ordered by mainstem and route measure, the
+# route measure of each vertex is computed from the cumulative length along its stream, and the point
+# upstream is found with a binary search (searchsorted) on the mainstem's streams and interpolated
+# linearly. The results are bulk loaded into the vertex gradient table with COPY. Setting
+# vertex_gradient_method = sql runs the original query in the database (ST_LocateAlong on a
+# measured copy of the geometry).
+#
+# The gradient can be computed over more than one distance (gradient_windows, for example 
+# 50,100,250). The first window is used for the gradient, grade_class, elevation_b and
+# upstream_pnt columns; with the numpy method every window is also stored in gradient_<window> 
+# and grade_class_<window> columns computed from the same vertex arrays (the sql method only
+# computes the first window).
 # 
 import appconfig
+import shapely
+import numpy as np
+
+try:
+    from processing_scripts import bulk_update
+except ModuleNotFoundError:
+    import bulk_update
 
 iniSection = appconfig.args.args[0]
 
@@ -49,6 +70,16 @@ dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_m
 dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
 
 db4dGeomField = "geometryzm"
+
+vertexGradientMethod = appconfig.config.get('GRADIENT_PROCESSING', 'vertex_gradient_method', fallback='numpy').strip().lower()
+
+#distances upstream (m) used to compute vertex gradients; the first 
+#is the gradient, grade_class, elevation_b and upstream_pnt columns
+gradientWindows = [int(substring.strip()) for substring in appconfig.config.get('GRADIENT_PROCESSING', 'gradient_windows', fallback='100').split(',')]
+gradientDistance = gradientWindows[0]
+
+#lower bound of each grade class; gradients below the first bound are class 0
+gradeClasses = [(0.05, 5), (0.07, 7), (0.10, 10), (0.12, 12), (0.15, 15), (0.20, 20), (0.25, 25), (0.30, 30)]
  
 def setupGeometry(connection):
     
@@ -76,10 +107,10 @@ def computeVertexGradients(connection):
             sv.{dbMainstemField},
             sv.{dbDownMeasureField} as downstream_route_measure,
             sv.elevation as elevation_a,
-            st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) as elevation_b,
-            (st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) - sv.elevation) / 100 as gradient,
+            st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + {gradientDistance}) - s2.{dbDownMeasureField} ))).geom) as elevation_b,
+            (st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + {gradientDistance}) - s2.{dbDownMeasureField} ))).geom) - sv.elevation) / {gradientDistance} as gradient,
             sv.pnt as vertex_pnt,
-            ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ) as upstream_pnt    
+            ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + {gradientDistance}) - s2.{dbDownMeasureField} ) as upstream_pnt    
         FROM (
            SELECT
             s.{dbMainstemField},
@@ -90,8 +121,8 @@ def computeVertexGradients(connection):
             ORDER BY {dbMainstemField}, {dbDownMeasureField}
         ) as sv
         INNER JOIN {dbTargetSchema}.{dbTargetStreamTable} s2 ON sv.{dbMainstemField} = s2.{dbMainstemField} 
-          AND sv.{dbDownMeasureField} + 100 >= s2.{dbDownMeasureField} 
-          AND sv.{dbDownMeasureField} + 100 < s2.{dbUpMeasureField};
+          AND sv.{dbDownMeasureField} + {gradientDistance} >= s2.{dbDownMeasureField} 
+          AND sv.{dbDownMeasureField} + {gradientDistance} < s2.{dbUpMeasureField};
           
 
         DELETE FROM {dbTargetSchema}.{dbVertexTable} WHERE elevation_a = -999999 or elevation_b = -999999;
@@ -127,6 +158,259 @@ def computeVertexGradients(connection):
 
 
 
+def loadMainstemStreams(connection):
+    """
+    Loads the smoothed geometry of all the streams on a mainstem
+    ordered by mainstem and route measure
+    
+    :return: (mainstemids, mainstem, downmeasure, upmeasure, coords, offsets);
+        the unique mainstem ids, for each stream the index of its mainstem
+        in mainstemids and its route measures, and the (vertices, 3) 
+        coordinates of all streams concatenated where the coordinates of 
+        stream i are coords[offsets[i]:offsets[i+1]]
+    """
+    query = f"""
+        SELECT {dbMainstemField}, {dbDownMeasureField}, {dbUpMeasureField}, st_asbinary({db3dGeomField})
+        FROM {dbTargetSchema}.{dbTargetStreamTable}
+        WHERE {dbMainstemField} IS NOT NULL 
+            AND {dbDownMeasureField} IS NOT NULL 
+            AND {db3dGeomField} IS NOT NULL
+        ORDER BY {dbMainstemField}, {dbDownMeasureField}, {dbUpMeasureField}
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+
+    mainstemids = []
+    mainstem = np.zeros(len(features), dtype=np.int64)
+    for i, feature in enumerate(features):
+        if (len(mainstemids) == 0 or mainstemids[-1] != feature[0]):
+            mainstemids.append(feature[0])
+        mainstem[i] = len(mainstemids) - 1
+    
+    measures = np.array([feature[1:3] for feature in features], dtype=np.float64).reshape(-1, 2)
+    
+    geoms = shapely.from_wkb([bytes(feature[3]) for feature in features])
+    coords = shapely.get_coordinates(geoms, include_z=True)
+    offsets = np.zeros(len(features) + 1, dtype=np.int64)
+    np.cumsum(shapely.get_num_coordinates(geoms), out=offsets[1:])
+    
+    return mainstemids, mainstem, measures[:, 0], measures[:, 1], coords, offsets
+
+
+def findStreams(mainstem, downmeasure, pointmainstem, pointmeasure):
+    """
+    Finds the stream of the mainstem that each point (route measure on 
+    a mainstem) falls in; streams must be ordered by mainstem and 
+    downstream route measure (then upstream measure, so a zero length 
+    stream comes before the stream starting at the same measure)
+    
+    :return: for each point the index of the last stream on the same 
+        mainstem with downstream measure <= point measure (-1 if there
+        isn't one)
+    """
+    #sort the streams and points together; streams come before points 
+    #with the same measure so the last stream before each point is the 
+    #stream it falls in
+    streamcnt = len(mainstem)
+    keys = np.concatenate((mainstem, pointmainstem))
+    values = np.concatenate((downmeasure, pointmeasure))
+    ispoint = np.concatenate((np.zeros(streamcnt, dtype=bool), np.ones(len(pointmainstem), dtype=bool)))
+    order = np.lexsort((ispoint, values, keys))
+    
+    laststream = np.where(order < streamcnt, order, -1)
+    laststream = np.maximum.accumulate(laststream)
+    
+    stream = np.empty(len(pointmainstem), dtype=np.int64)
+    stream[order[order >= streamcnt] - streamcnt] = laststream[order >= streamcnt]
+    stream[(stream >= 0) & (mainstem[np.maximum(stream, 0)] != pointmainstem)] = -1
+    return stream
+
+
+class MainstemProfile:
+    """
+    The vertices of all mainstems with their route measures; used to 
+    locate points a given distance upstream of each vertex
+    """
+    
+    def __init__(self, mainstem, downmeasure, upmeasure, coords, offsets):
+        """
+        :param mainstem: mainstem index of each stream; streams are ordered
+            by mainstem and route measure (see loadMainstemStreams)
+        :param downmeasure: downstream route measure of each stream
+        :param upmeasure: upstream route measure of each stream
+        :param coords: (vertices, 3) coordinates of all streams concatenated
+        :param offsets: offset of each stream in coords
+        """
+        self.mainstem = mainstem
+        self.downmeasure = downmeasure
+        self.upmeasure = upmeasure
+        self.coords = coords
+        
+        counts = np.diff(offsets)
+        self.first = offsets[:-1]
+        self.last = offsets[1:] - 1
+        
+        #distance of each vertex from the start (upstream end) of its stream
+        step = np.zeros(len(coords), dtype=np.float64)
+        step[1:] = np.hypot(np.diff(coords[:, 0]), np.diff(coords[:, 1]))
+        step[self.first] = 0
+        self.distance = np.cumsum(step)
+        self.distance -= np.repeat(self.distance[self.first], counts)
+        self.length = self.distance[self.last]
+        
+        #the streams are laid out one after another (with a gap) so 
+        #a single sorted array can be searched for a distance on a stream
+        self.base = np.zeros(len(counts), dtype=np.float64)
+        self.base[1:] = np.cumsum(self.length + 1)[:-1]
+        self.position = self.distance + np.repeat(self.base, counts)
+        
+        #all vertices except the last (downstream end) of each stream; 
+        #m is the distance from the downstream end of the stream
+        vertex = np.ones(len(coords), dtype=bool)
+        vertex[self.last] = False
+        self.vertex = np.flatnonzero(vertex)
+        self.vertexstream = np.repeat(np.arange(len(counts)), counts)[self.vertex]
+        self.vertexm = self.length[self.vertexstream] - self.distance[self.vertex]
+        self.vertexmeasure = self.downmeasure[self.vertexstream] + self.vertexm
+        self.elevation = coords[self.vertex, 2]
+
+    def locateUpstream(self, window):
+        """
+        Finds the point window metres upstream of each vertex 
+        on the same mainstem
+        
+        :return: (valid, coords, m); valid is false where the mainstem
+            ends (or has a gap) before the point, coords are the (x, y, z) 
+            coordinates of the points and m the distance of the point from 
+            the downstream end of its stream
+        """
+        pointmeasure = self.vertexmeasure + window
+        stream = findStreams(self.mainstem, self.downmeasure, self.mainstem[self.vertexstream], pointmeasure)
+        valid = stream >= 0
+        stream = np.maximum(stream, 0)
+        m = pointmeasure - self.downmeasure[stream]
+        distance = self.length[stream] - m
+        valid &= (pointmeasure < self.upmeasure[stream]) & (distance >= 0)
+        
+        #interpolate between the vertices of the stream
+        first = self.first[stream]
+        index = np.searchsorted(self.position, self.base[stream] + distance, side='right') - 1
+        index = np.clip(index, first, np.maximum(self.last[stream] - 1, first))
+        
+        seglength = self.distance[index + 1] - self.distance[index]
+        fraction = np.divide(distance - self.distance[index], seglength, out=np.zeros(len(index)), where=seglength > 0)
+        fraction = np.clip(fraction, 0, 1)
+        coords = self.coords[index] + (self.coords[index + 1] - self.coords[index]) * fraction[:, np.newaxis]
+        return valid, coords, m
+    
+    def getGradient(self, window):
+        """
+        Computes the gradient over window metres upstream of each vertex
+        
+        :return: (gradient, coords, m); gradient is nan where it can't be 
+            computed (no upstream point or no elevation) otherwise see
+            locateUpstream
+        """
+        valid, coords, m = self.locateUpstream(window)
+        valid &= (self.elevation != appconfig.NODATA) & (coords[:, 2] != appconfig.NODATA)
+        gradient = np.where(valid, (coords[:, 2] - self.elevation) / window, np.nan)
+        return gradient, coords, m
+
+
+def getGradeClass(gradient):
+    """
+    Returns the grade class of each gradient
+    """
+    bounds = [bound for bound, gradeclass in gradeClasses]
+    classes = np.array([0] + [gradeclass for bound, gradeclass in gradeClasses], dtype=np.int64)
+    return classes[np.searchsorted(bounds, gradient, side='right')]
+
+
+def computeMainstemGradients(connection):
+    """
+    Computes the vertex gradients for all gradient windows in Python 
+    and loads them into the vertex gradient table. Vertices are kept 
+    if the gradient of the first window can be computed; the other
+    windows are null where they can't be computed.
+    """
+    mainstemids, mainstem, downmeasure, upmeasure, coords, offsets = loadMainstemStreams(connection)
+    
+    profile = MainstemProfile(mainstem, downmeasure, upmeasure, coords, offsets)
+    
+    gradient, upcoords, upm = profile.getGradient(gradientDistance)
+    valid = ~np.isnan(gradient)
+    
+    vertex = profile.vertex[valid]
+    rows = [
+        [mainstemids[i] for i in mainstem[profile.vertexstream[valid]].tolist()],
+        profile.vertexmeasure[valid].tolist(), profile.elevation[valid].tolist(), 
+        upcoords[valid, 2].tolist(), gradient[valid].tolist(),
+        coords[vertex, 0].tolist(), coords[vertex, 1].tolist(), profile.vertexm[valid].tolist(),
+        upcoords[valid, 0].tolist(), upcoords[valid, 1].tolist(), upm[valid].tolist(), 
+        getGradeClass(gradient[valid]).tolist()]
+    
+    columns = [(dbMainstemField, 'uuid'), ('downstream_route_measure', 'double precision'),
+               ('elevation_a', 'double precision'), ('elevation_b', 'double precision'), 
+               ('gradient', 'double precision'), 
+               ('vertex_x', 'double precision'), ('vertex_y', 'double precision'), ('vertex_m', 'double precision'),
+               ('upstream_x', 'double precision'), ('upstream_y', 'double precision'), ('upstream_m', 'double precision'),
+               ('grade_class', 'integer')]
+    
+    #gradient and grade class for each window; null where it can't be computed
+    windowcolumns = []
+    for window in gradientWindows:
+        windowgradient = gradient if window == gradientDistance else profile.getGradient(window)[0]
+        windowgradient = windowgradient[valid]
+        hasgradient = ~np.isnan(windowgradient)
+        windowclass = getGradeClass(windowgradient)
+        rows.append([value if has else None for value, has in zip(windowgradient.tolist(), hasgradient.tolist())])
+        rows.append([value if has else None for value, has in zip(windowclass.tolist(), hasgradient.tolist())])
+        columns.append((f"gradient_{window}", 'double precision'))
+        columns.append((f"grade_class_{window}", 'integer'))
+        windowcolumns.append(f"gradient_{window} real")
+        windowcolumns.append(f"grade_class_{window} smallint")
+    
+    windowcolumns = "".join(f",\n                {column}" for column in windowcolumns)
+    windownames = "".join(f", gradient_{window}, grade_class_{window}" for window in gradientWindows)
+    
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            DROP TABLE IF EXISTS {dbTargetSchema}.{dbVertexTable};
+            
+            CREATE TABLE {dbTargetSchema}.{dbVertexTable} (
+                {dbMainstemField} uuid,
+                downstream_route_measure double precision,
+                elevation_a double precision,
+                elevation_b double precision,
+                gradient double precision,
+                vertex_pnt geometry(PointZM, {appconfig.dataSrid}),
+                upstream_pnt geometry(MultiPointZM, {appconfig.dataSrid}),
+                grade_class smallint{windowcolumns}
+            );
+        """)
+        
+        staging = bulk_update.createStagingTable(cursor, dbTargetSchema, f"{dbVertexTable}_staging", columns)
+        bulk_update.copyRows(cursor, staging, columns, zip(*rows))
+        
+        cursor.execute(f"""
+            INSERT INTO {dbTargetSchema}.{dbVertexTable} 
+                ({dbMainstemField}, downstream_route_measure, elevation_a, elevation_b, 
+                gradient, vertex_pnt, upstream_pnt, grade_class{windownames})
+            SELECT {dbMainstemField}, downstream_route_measure, elevation_a, elevation_b, gradient,
+                st_setsrid(st_makepoint(vertex_x, vertex_y, elevation_a, vertex_m), {appconfig.dataSrid}),
+                st_setsrid(st_multi(st_makepoint(upstream_x, upstream_y, elevation_b, upstream_m)), {appconfig.dataSrid}),
+                grade_class{windownames}
+            FROM {staging};
+            
+            DROP TABLE {staging};
+            
+            ALTER TABLE  {dbTargetSchema}.{dbVertexTable} OWNER TO cwf_analyst;
+        """)
+            
+    connection.commit()
+
+
 def main():
     #--- main program ---    
     with appconfig.connectdb() as conn:
@@ -134,11 +418,15 @@ def main():
         conn.autocommit = False
         
         print("Computing Gradient")
-        print("  setting up tables")
-        setupGeometry(conn)
-        
-        print("  computing vertex gradients")
-        computeVertexGradients(conn)
+        if (vertexGradientMethod == 'sql'):
+            print("  setting up tables")
+            setupGeometry(conn)
+            
+            print("  computing vertex gradients")
+            computeVertexGradients(conn)
+        else:
+            print("  computing vertex gradients")
+            computeMainstemGradients(conn)
         
         
     print("done")
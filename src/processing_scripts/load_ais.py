@@ -86,12 +86,12 @@ def main():
                 FROM {datatable} ais
                 CROSS JOIN LATERAL
                 (
-                    WITH RECURSIVE upstream(id, geometry) AS (
-                        SELECT id, geometry FROM {iniSection}.{streamTable} WHERE id = CAST(ais.stream_id AS uuid)      -- Initial step at stream segment of ais point
+                    WITH RECURSIVE upstream(id, start_point) AS (
+                        SELECT id, start_point FROM {iniSection}.{streamTable} WHERE id = CAST(ais.stream_id AS uuid)    -- Initial step at stream segment of ais point
                         UNION ALL
-                        SELECT n.id, n.geometry                                                                         -- union with all stream segments upstream
+                        SELECT n.id, n.start_point                                                                      -- union with all stream segments upstream
                         FROM {iniSection}.{streamTable} n, upstream w
-                        WHERE ST_DWithin(ST_StartPoint(w.geometry),ST_EndPoint(n.geometry),0.01)                        -- recursively get next stream segment by finding where the startpt of next segment is within 0.01
+                        WHERE ST_DWithin(w.start_point, n.end_point, 0.01)                                              -- recursively get next stream segment by finding where the startpt of next segment is within 0.01
                         AND n.id IS NOT NULL                                                                            -- of endpt of this segment    
                     )
                     SELECT u.id as stream_id, b.id as barrier_id, b.barrier_cnt_downstr_as                              -- identify the nearest barrier downstream of the ais point
@@ -125,14 +125,13 @@ def main():
                 FROM {datatable} ais
                 CROSS JOIN LATERAL
                 (
-                    WITH RECURSIVE downstream(id, geometry) AS (
-                        SELECT id, geometry FROM {iniSection}.{streamTable} WHERE id = CAST(ais.stream_id AS uuid)
+                    WITH RECURSIVE downstream(id, end_point) AS (
+                        SELECT id, end_point FROM {iniSection}.{streamTable} WHERE id = CAST(ais.stream_id AS uuid)
                         UNION ALL
-                        SELECT n.id, n.geometry
+                        SELECT n.id, n.end_point
                         FROM {iniSection}.{streamTable} n
                         INNER JOIN downstream w 
-                            ON n.geometry && ST_Buffer(ST_EndPoint(w.geometry), 0.0001) -- Uses index
-                            AND ST_DWithin(ST_EndPoint(w.geometry), ST_StartPoint(n.geometry), 0.0001)
+                            ON ST_DWithin(w.end_point, n.start_point, 0.0001) -- Uses start_point index
 
 
                         --FROM {iniSection}.{streamTable} n, downstream w
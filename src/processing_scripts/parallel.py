@@ -0,0 +1,100 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Helpers for running processing steps in a pool of worker processes.
+#
+# DESCRIPTION
+#
+# Large numpy arrays are published once with share(); when running in
+# parallel they are copied into multiprocessing.shared_memory blocks before
+# the worker processes are started, so workers read them from the
+# shared dictionary without any copying or pickling. Tasks passed to
+# mapTasks should be small (names and index ranges) and the function must
+# be defined at module level.
+#
+# Worker processes are started with fork. The processing scripts prompt
+# for database credentials when appconfig is imported, so they can't be
+# re-imported in a spawned process; on platforms without fork (Windows)
+# tasks are run one after another in the current process.
+#
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import os
+
+#arrays available to the worker processes
+shared = dict()
+
+_blocks = []
+
+def getWorkerCount(workers):
+    """
+    Returns the number of worker processes to use for the configured
+    value; 0 (or less) uses one worker per cpu
+    """
+    if (workers <= 0):
+        return os.cpu_count() or 1
+    return workers
+
+def isParallel(workers):
+    """
+    Returns true if tasks will be run in worker processes
+    """
+    return workers > 1 and 'fork' in multiprocessing.get_all_start_methods()
+
+def share(arrays, workers):
+    """
+    Publishes the arrays to the worker processes; must be called
+    before mapTasks
+
+    :param arrays: dictionary of name to numpy array
+    :param workers: number of worker processes that will be used
+    """
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        if (isParallel(workers)):
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            _blocks.append(block)
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            view[...] = array
+            array = view
+        shared[name] = array
+
+def release():
+    """
+    Discards all shared arrays and frees the shared memory
+    """
+    shared.clear()
+    for block in _blocks:
+        block.close()
+        block.unlink()
+    _blocks.clear()
+
+def mapTasks(function, tasks, workers):
+    """
+    Calls function for each task and returns the results in task order.
+    The tasks are split between worker processes if more than one worker
+    is configured.
+    """
+    if (not isParallel(workers) or len(tasks) <= 1):
+        return [function(task) for task in tasks]
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(workers, len(tasks))) as pool:
+        return pool.map(function, tasks)
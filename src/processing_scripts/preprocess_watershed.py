@@ -37,6 +37,7 @@
 # -	Snaps geometries to a 0.01 unit grid.
 # -	Removes any empty geometries created during intersection.
 # -	Preserves original geometry in a separate column before snapping.
+# -	Stores the start and end point of each stream in GiST indexed start_point/end_point columns.
 # 5.Placeholder Data: Temporarily populates channel confinement and discharge fields with random values (marked TODO for real data).
 # 6.Secondary Watershed Attribution: If available, adds secondary watershed codes/names via spatial intersection; otherwise uses the config section name.
 # 
@@ -44,6 +45,11 @@
 import appconfig
 import ast
 
+try:
+    from processing_scripts import stream_network
+except ModuleNotFoundError:
+    import stream_network
+
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
 
@@ -300,6 +306,10 @@ def main():
         with conn.cursor() as cursor:
             cursor.execute(query)
         conn.commit()
+
+        stream_network.updateEndpoints(conn, dbTargetSchema, dbTargetStreamTable)
+
+    stream_network.invalidateNetwork(dbTargetSchema, dbTargetStreamTable)
         
     print(f"""Initializing processing for watershed {workingWatershedId} complete.""")
 
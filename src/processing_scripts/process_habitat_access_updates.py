@@ -68,7 +68,7 @@ def getUpstreamDownstream(conn):
             SELECT a.id as stream_id, b.id as barrier_id
             FROM {dbTargetSchema}.{dbTargetStreamTable} a,
                 {dbTargetSchema}.{dbHabAccessUpdates} b
-            WHERE ST_DWithin(ST_endPoint(a.geometry), b.snapped_point, 10)
+            WHERE ST_DWithin(a.end_point, b.snapped_point, 10)
         )
         UPDATE {dbTargetSchema}.{dbHabAccessUpdates}
             SET stream_id_up = a.stream_id
@@ -83,7 +83,7 @@ def getUpstreamDownstream(conn):
             SELECT a.id as stream_id, b.id as barrier_id
             FROM {dbTargetSchema}.{dbTargetStreamTable} a,
                 {dbTargetSchema}.{dbHabAccessUpdates} b
-            WHERE ST_DWithin(ST_startPoint(a.geometry), b.snapped_point, 10)
+            WHERE ST_DWithin(a.start_point, b.snapped_point, 10)
         )
         UPDATE {dbTargetSchema}.{dbHabAccessUpdates}
             SET stream_id_down = a.stream_id
@@ -108,24 +108,24 @@ def getUpstreamDownstream(conn):
 
         IF limit_id IS NOT NULL THEN
             RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
+            WITH RECURSIVE walk_network(id, end_point) AS (
+                SELECT id, end_point FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
                 UNION ALL
-                SELECT n.id, n.geometry
+                SELECT n.id, n.end_point
                 FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_EndPoint(w.geometry),ST_StartPoint(n.geometry),0.01)
+                WHERE ST_DWithin(w.end_point, n.start_point, 0.01)
                 and n.id != $2
             )
             SELECT id FROM walk_network;
 
         ELSE
             RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
+            WITH RECURSIVE walk_network(id, end_point) AS (
+                SELECT id, end_point FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
                 UNION ALL
-                SELECT n.id, n.geometry
+                SELECT n.id, n.end_point
                 FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_EndPoint(w.geometry),ST_StartPoint(n.geometry),0.01)
+                WHERE ST_DWithin(w.end_point, n.start_point, 0.01)
                 and n.id IS NOT NULL
             )
             SELECT id FROM walk_network;
@@ -144,24 +144,24 @@ def getUpstreamDownstream(conn):
 
         IF limit_id IS NOT NULL THEN
             RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
+            WITH RECURSIVE walk_network(id, start_point) AS (
+                SELECT id, start_point FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
                 UNION ALL
-                SELECT n.id, n.geometry
+                SELECT n.id, n.start_point
                 FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_StartPoint(w.geometry),ST_EndPoint(n.geometry),0.01)
+                WHERE ST_DWithin(w.start_point, n.end_point, 0.01)
                 and n.id != $2
             )
             SELECT id FROM walk_network;
 
         ELSE
             RETURN QUERY
-            WITH RECURSIVE walk_network(id, geometry) AS (
-                SELECT id, geometry FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
+            WITH RECURSIVE walk_network(id, start_point) AS (
+                SELECT id, start_point FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE id = $1
                 UNION ALL
-                SELECT n.id, n.geometry
+                SELECT n.id, n.start_point
                 FROM {dbTargetSchema}.{dbTargetStreamTable} n, walk_network w
-                WHERE ST_DWithin(ST_StartPoint(w.geometry),ST_EndPoint(n.geometry),0.01)
+                WHERE ST_DWithin(w.start_point, n.end_point, 0.01)
                 and n.id IS NOT NULL
             )
             SELECT id FROM walk_network;
@@ -25,10 +25,15 @@
 #
 import appconfig
 import networkx as nx
-import shapely.wkb
+import numpy as np
 from tqdm import tqdm
 import psycopg2.extras as pg2e
 
+try:
+    from processing_scripts import stream_network
+except ModuleNotFoundError:
+    import stream_network
+
 import sys
 
 iniSection = appconfig.args.args[0]
@@ -71,7 +76,7 @@ def disconnectedIslands(conn):
 
     # Get the stream network
     query = f"""
-        SELECT id, geometry 
+        SELECT id, st_asewkb(geometry)
         FROM {dbTargetSchema}.{dbTargetStreamTable}_copy
     """
 
@@ -79,18 +84,16 @@ def disconnectedIslands(conn):
         cursor.execute(query)
         features = cursor.fetchall()
 
-    for feat in features:
-        geom = shapely.wkb.loads(feat[1], hex=True) # linestring from feature of stream network
+    # linestring coordinates for all features of stream network
+    allcoords = stream_network.getCoordinates([feat[1] for feat in features])
+
+    for feat, coords in zip(features, allcoords):
+        pnts = [tuple(pnt) for pnt in (coords / tolerance).astype(np.int64).tolist()]
 
         # build a network
-        for i in range(len(geom.coords)-1): 
-            G.add_edges_from(
-                [
-                    ((int(geom.coords[i][0]/tolerance), int(geom.coords[i][1]/tolerance)),
-                     (int(geom.coords[i+1][0]/tolerance), int(geom.coords[i+1][1]/tolerance)),
-                     {'fid': feat[0]})
-                ]
-            )
+        G.add_edges_from(
+            [(pnts[i], pnts[i+1], {'fid': feat[0]}) for i in range(len(pnts)-1)]
+        )
 
     query = f"""
         DROP TABLE IF EXISTS network_groups;
@@ -220,6 +223,8 @@ def main():
         print("  deleting isolated flowpaths")
         deleteIsolated(conn)
 
+    stream_network.invalidateNetwork(dbTargetSchema, dbTargetStreamTable)
+
     print("done")
 
 
@@ -23,10 +23,10 @@
 # 
 #This Python script smooths elevation values along a stream network to ensure water flows consistently downhill, correcting any anomalies in the raw elevation data. The script will update the streams table with a single gradient value for each complete stream segment. The output of the script is a new geometry column containing smoothed 3D stream segments where elevations decrease consistently from upstream to downstream, eliminating any artificial "uphill" sections that would be physically impossible. There are four main steps to how this script operates.
 # 1.	Build a network structure: 
-# -	Reads all stream segments from the database
-# -	Creates a graph structure with nodes (junction points where streams meet) and edges (stream segments connecting nodes)
-# -	Each node stores its x, y, and z coordinates
-# -	Each edge stores its geometry and connects two nodes
+# -	Uses the shared stream network (stream_network.py) for the graph structure with nodes (junction points where streams meet) and edges (stream segments connecting nodes)
+# -	Reads the raw 3d geometry of all stream segments from the database
+# -	Each node stores its z value, taken from the end points of the raw 3d geometries
+# -	The raw 3d coordinates of all edges are stored in a single array in edge order with the offset of each edge
 # 2.	Process nodes in two passes: 
 # -	Upstream pass (walking up the network): 
 #   -	Starts at outlet points (nodes with no downstream connections)
@@ -47,15 +47,31 @@
 #   -	From downstream: ensures each point isn't lower than points downstream
 #   -	From upstream: ensures each point isn't higher than points upstream
 # -	Averages these constraints to create a smooth, monotonically decreasing elevation profile along each stream
+# -	The running minimum and maximum are computed for all edges at once on the concatenated coordinate array
 # 4.	Write results back to database: 
-# -	Updates the database with new smoothed geometries
+# -	Updates the database with new smoothed geometries (the raw geometries with the smoothed z values)
 # -	Creates spatial indexes for efficient querying
+#
+# The network is split into independent drainage basins (edges connected to the same
+# outlets; see StreamNetwork.getBasins). Steps 2 to 4 only follow connected edges so 
+# basins can be processed separately: if smooth_basin_edges is set the basins are 
+# grouped into batches of at most that many edges and the geometries of each batch are 
+# loaded, smoothed and written before the next batch, so memory use is bounded by the 
+# batch rather than the whole watershed. If smooth_workers is more than one the basins 
+# of a batch are smoothed in parallel worker processes.
 
 import appconfig
-import shapely.wkb
-import shapely.geometry
-import psycopg2.extras
-from collections import deque
+import shapely
+import numpy as np
+
+try:
+    from processing_scripts import stream_network
+    from processing_scripts import bulk_update
+    from processing_scripts import parallel
+except ModuleNotFoundError:
+    import stream_network
+    import bulk_update
+    import parallel
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -63,232 +79,273 @@ dbTargetTable = appconfig.config['PROCESSING']['stream_table']
 
 dbSourceGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
-    
-edges = []
-nodes = dict()
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.z = appconfig.NODATA
-        self.minvalue = self.z
-        self.maxvalue = self.z
-        
+smoothWorkers = parallel.getWorkerCount(appconfig.config.getint('ELEVATION_PROCESSING', 'smooth_workers', fallback=1))
+smoothBasinEdges = appconfig.config.getint('ELEVATION_PROCESSING', 'smooth_basin_edges', fallback=0)
 
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-        self.addZ(edge.ls.coords[len(edge.ls.coords) - 1][2])
+network = None
 
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-        self.addZ(edge.ls.coords[0][2])
+def getBatches():
+    """
+    Groups the drainage basins of the network into batches of at most
+    smoothBasinEdges edges (a larger basin is a batch on its own). All 
+    edges are a single batch if smoothBasinEdges is 0.
     
-    def addZ(self, z):
-        if (self.z == appconfig.NODATA or self.z == z):
-            self.z = z
-        else:
-            print("DIFFERENT Z VALUES AT SAME POSITION: POINT(" + str(self.x) + " " + str(self.y) + "): " +str(self.x) + " " +str(z))
+    :return: list of arrays of edge indices; the edges of each
+        basin are together and in edge order
+    """
+    basins = network.getBasins()
+    edges = np.argsort(basins, kind='stable')
+    if (smoothBasinEdges <= 0):
+        return [edges]
     
-class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.newz = [appconfig.NODATA for i in range(len(ls.coords))]
-        
-def createNetwork(connection):
+    batches = []
+    start = 0
+    size = 0
+    for basin, count in enumerate(np.bincount(basins).tolist()):
+        if (size > 0 and size + count > smoothBasinEdges):
+            batches.append(edges[start:start + size])
+            start += size
+            size = 0
+        size += count
+    if (size > 0):
+        batches.append(edges[start:start + size])
+    return batches
+
+
+def loadEdges(connection, edges):
+    """
+    Loads the raw 3d geometries of the edges
+    
+    :return: (geometries, coordinates, offsets); geometries in edge
+        order and the (vertices, 3) coordinates of all geometries
+        concatenated, the coordinates of edges[i] are 
+        coords[offsets[i]:offsets[i+1]]
+    """
     query = f"""
-        SELECT {appconfig.dbIdField}, {dbSourceGeom}
+        SELECT {appconfig.dbIdField}, st_asewkb({dbSourceGeom})
         FROM {dbTargetSchema}.{dbTargetTable}
     """
-   
-    #load geometries and create a network
+    params = None
+    if (len(edges) < network.edgeCount):
+        query += f" WHERE {appconfig.dbIdField} = ANY(%s)"
+        params = ([network.getFid(edge) for edge in edges],)
+
     with connection.cursor() as cursor:
-        cursor.execute(query)
+        cursor.execute(query, params)
         features = cursor.fetchall()
-        
-        
-        for feature in features:
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            fid = feature[0]
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
-
-def processNodes():
-    
-    #walk up network
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-            node.maxvalue = node.z
+
+    #position of each feature in edges
+    position = np.full(network.edgeCount, -1, dtype=np.int64)
+    position[edges] = np.arange(len(edges))
+    index = position[network.indexOf([feature[0] for feature in features])]
+
+    geoms = np.empty(len(edges), dtype=object)
+    geoms[index] = shapely.from_wkb([bytes(feature[1]) for feature in features])
     
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        for outedge in node.outedges:
-            if not outedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for inedge in node.inedges:
-                inedge.fromNode.maxvalue = max(node.maxvalue, inedge.fromNode.z)
-                inedge.visited = True
-                toprocess.append(inedge.fromNode)
+    coords = shapely.get_coordinates(geoms, include_z=True)
+    offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum(shapely.get_num_coordinates(geoms), out=offsets[1:])
+    return geoms, coords, offsets
+
+
+def getNodeZ(edges, coords, offsets):
+    """
+    Returns the raw z value of each node; the first elevation 
+    (not NODATA) found at the node with nodes visited in edge order,
+    from node then to node
+    """
+    nodes = np.column_stack((network.fromNode[edges], network.toNode[edges])).ravel()
+    z = np.column_stack((coords[offsets[:-1], 2], coords[offsets[1:] - 1, 2])).ravel()
     
-    #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        node.minvalue = node.z
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-     
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for outedge in node.outedges:
-                if (node.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = outedge.toNode.minvalue 
-                elif (outedge.toNode.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = node.minvalue
-                else: 
-                    outedge.toNode.minvalue = min(node.minvalue, outedge.toNode.minvalue)
-                                   
-                outedge.visited = True
-                
-                if (outedge.toNode in toprocess):
-                    toprocess.remove(outedge.toNode)
-                toprocess.append(outedge.toNode)     
+    nodez = np.full(network.nodeCount, appconfig.NODATA, dtype=np.float64)
+    hasz = np.flatnonzero(z != appconfig.NODATA)
+    firstnode, first = np.unique(nodes[hasz], return_index=True)
+    first = hasz[first]
+    nodez[firstnode] = z[first]
     
-    #update z values 
-    for node in nodes.values():
-        if (node.maxvalue == appconfig.NODATA or node.minvalue == appconfig.NODATA):
-            node.z = appconfig.NODATA
-        else:
-            node.z = (node.maxvalue + node.minvalue) / 2.0
-        
-    for edge in edges:
-        edge.newz[0] = edge.fromNode.z
-        edge.newz[len(edge.ls.coords)-1] = edge.toNode.z
+    firstindex = np.full(network.nodeCount, len(nodes), dtype=np.int64)
+    firstindex[firstnode] = first
+    conflicts = (np.arange(len(nodes)) > firstindex[nodes]) & (z != nodez[nodes])
+    for i in np.flatnonzero(conflicts):
+        node = nodes[i]
+        print("DIFFERENT Z VALUES AT SAME POSITION: POINT(" + str(network.nodex[node]) + " " + str(network.nodey[node]) + "): " +str(network.nodex[node]) + " " +str(z[i]))
+    return nodez
 
 
-def processEdges():   
+def processNodes(edges, nodez):
+    """
+    Smooths the node z values of the nodes of the edges in place
+    """
+    innodes = np.zeros(network.nodeCount, dtype=bool)
+    innodes[network.fromNode[edges]] = True
+    innodes[network.toNode[edges]] = True
     
-    for edge in edges:             
-        ls = edge.ls
-        
-        size = len(ls.coords)
-        
-        minvalues = [appconfig.NODATA] * size
-        maxvalues = [appconfig.NODATA] * size
-        
-        absmax = edge.newz[0]
-        absmin = edge.newz[size - 1]
-        
-        minvalues [0] = edge.newz[0]
-        maxvalues [size - 1] = edge.newz[size - 1]
-        
-        
-        for i in range(1, size):
-            temp = ls.coords[i][2]
-            if (temp < absmin):
-                temp = absmin
-            minv = min(temp, minvalues[i-1])
-            minvalues[i] = minv
-            
-            temp = ls.coords[size - 1 - i][2]
-            if (temp > absmax):
-                temp = absmax
-            maxv = max(temp, maxvalues[size - i])
-            maxvalues [size - 1 - i ] = maxv
-        
-        for i in range(0, size):
-            if minvalues[i] == appconfig.NODATA or maxvalues[i] == appconfig.NODATA:
-                edge.newz[i] = appconfig.NODATA
+    outdegree = network.getOutDegree()
+
+    #walk up network
+    maxvalue = np.full(network.nodeCount, appconfig.NODATA, dtype=np.float64)
+    outlets = innodes & (outdegree == 0)
+    maxvalue[outlets] = nodez[outlets]
+
+    def visitUp(node):
+        for inedge in network.getInEdges(node):
+            fromnode = network.fromNode[inedge]
+            maxvalue[fromnode] = max(maxvalue[node], nodez[fromnode])
+
+    network.walkUpstream(visitUp, innodes)
+
+    #walk down network
+    minvalue = nodez.copy()
+
+    def visitDown(node):
+        if (minvalue[node] == appconfig.NODATA):
+            return
+        for outedge in network.getOutEdges(node):
+            tonode = network.toNode[outedge]
+            if (minvalue[tonode] == appconfig.NODATA):
+                minvalue[tonode] = minvalue[node]
             else:
-                edge.newz[i] = ((minvalues[i] + maxvalues[i]) / 2.0)
-        
-        
-def writeResults(connection):
+                minvalue[tonode] = min(minvalue[node], minvalue[tonode])
+
+    network.walkDownstream(visitDown, innodes)
+
+    #update z values
+    nodata = (maxvalue == appconfig.NODATA) | (minvalue == appconfig.NODATA)
+    nodez[innodes] = np.where(nodata, appconfig.NODATA, (maxvalue + minvalue) / 2.0)[innodes]
+
+
+def accumulateSegments(ufunc, values, offsets):
+    """
+    Computes the running ufunc (np.minimum or np.maximum) of the values 
+    separately for each segment of a ragged array
+    
+    :param values: array of values of all segments concatenated
+    :param offsets: start of each segment in values followed by the 
+        length of values
+    :return: array of accumulated values
+    """
+    result = values.copy()
+    lengths = np.diff(offsets)
+    if (len(lengths) == 0):
+        return result
+    position = np.arange(len(values)) - np.repeat(offsets[:-1], lengths)
     
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetTable} 
-        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{appconfig.dataSrid})
-        WHERE  {appconfig.dbIdField} = %s
+    #prefix scan; after each step every value includes the 
+    #values up to 2 * step positions before it in its segment
+    step = 1
+    while step < lengths.max():
+        index = np.flatnonzero(position >= step)
+        result[index] = ufunc(result[index], result[index - step])
+        step *= 2
+    return result
+
+
+def processEdges(edges, nodez, coords, offsets):
     """
+    Smooths the z values along the edges between the smoothed
+    node values
     
-    newdata = []
+    :return: the new z value of each coordinate
+    """
+    startz = nodez[network.fromNode[edges]]
+    endz = nodez[network.toNode[edges]]
+    lengths = np.diff(offsets)
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    rawz = coords[:, 2]
     
-    for edge in edges:
-        newpnts = [];
-        for i in range(0, len(edge.ls.coords)):
-            x = edge.ls.coords[i][0]
-            y = edge.ls.coords[i][1]
-            z = edge.newz[i]
-            newpnts.append((x,y,z))
-        ls = shapely.geometry.LineString(newpnts)
-        newdata.append( (shapely.wkb.dumps(ls), edge.fid))
+    #running minimum from the start of each edge; values can't be 
+    #lower than the end node and the first value is the start node
+    values = np.maximum(rawz, np.repeat(endz, lengths))
+    values[first] = startz
+    minvalues = accumulateSegments(np.minimum, values, offsets)
     
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata);
-            
-    connection.commit()
+    #running maximum from the end of each edge; values can't be 
+    #higher than the start node and the last value is the end node
+    values = np.minimum(rawz, np.repeat(startz, lengths))
+    values[last] = endz
+    reverseoffsets = len(values) - offsets[::-1]
+    maxvalues = accumulateSegments(np.maximum, values[::-1], reverseoffsets)[::-1]
     
+    nodata = (minvalues == appconfig.NODATA) | (maxvalues == appconfig.NODATA)
+    return np.where(nodata, appconfig.NODATA, (minvalues + maxvalues) / 2.0)
+
+
+def smoothEdges(edges, coords, offsets):
+    """
+    Smooths the z values of the edges; the edges must include
+    whole drainage basins
+
+    :return: the new z value of each coordinate
+    """
+    nodez = getNodeZ(edges, coords, offsets)
+    processNodes(edges, nodez)
+    return processEdges(edges, nodez, coords, offsets)
+
+
+def smoothTask(task):
+    #smooths the edges start to end of the shared batch
+    start, end = task
+    offsets = parallel.shared['offsets']
+    edges = parallel.shared['edges'][start:end]
+    coords = parallel.shared['coords'][offsets[start]:offsets[end]]
+    return smoothEdges(edges, coords, offsets[start:end + 1] - offsets[start])
+
+
+def getTasks(edges):
+    """
+    Splits the edges of a batch into tasks for the worker processes 
+    without splitting any basins
+
+    :return: list of (start, end) edge ranges
+    """
+    basins = network.getBasins()[edges]
+    starts = np.flatnonzero(np.diff(basins)) + 1
+    
+    #a few tasks per worker so large basins don't hold up the others
+    limits = np.linspace(0, len(edges), smoothWorkers * 4 + 1)[1:-1]
+    index = np.searchsorted(starts, limits)
+    splits = np.unique(starts[index[index < len(starts)]])
+    bounds = [0] + splits.tolist() + [len(edges)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def processBatch(connection, edges):
+    
+    geoms, coords, offsets = loadEdges(connection, edges)
+    
+    if (not parallel.isParallel(smoothWorkers)):
+        newz = smoothEdges(edges, coords, offsets)
+    else:
+        tasks = getTasks(edges)
+        parallel.share({'edges': edges, 'coords': coords, 'offsets': offsets}, smoothWorkers)
+        try:
+            newz = np.concatenate(parallel.mapTasks(smoothTask, tasks, smoothWorkers))
+        finally:
+            parallel.release()
+    
+    writeResults(connection, edges, geoms, coords, newz)
+
+
+def writeResults(connection, edges, geoms, coords, newz):
+
+    newcoords = coords.copy()
+    newcoords[:, 2] = newz
+    geoms = shapely.set_coordinates(geoms.copy(), newcoords)
+    
+    newdata = zip([network.getFid(edge) for edge in edges], shapely.to_wkb(geoms))
+
+    columns = [(appconfig.dbIdField, 'uuid'), (dbTargetGeom, 'bytea')]
+    assign = {dbTargetGeom: f"st_setsrid(st_geomfromwkb(s.{dbTargetGeom}),{appconfig.dataSrid})"}
+    bulk_update.updateTable(connection, dbTargetSchema, dbTargetTable, columns, newdata, assign)
+
+    connection.commit()
+
 
 #--- main program ---    
 def main():
-    
-    edges.clear()
-    nodes.clear()
+    global network
 
     with appconfig.connectdb() as conn:
         
@@ -305,16 +362,13 @@ def main():
             cursor.execute(query)
         
         print("  creating network")
-        createNetwork(conn)
-        
-        print("  processing nodes")
-        processNodes()
+        network = stream_network.getNetwork(conn, dbTargetSchema, dbTargetTable)
         
-        print("  processing edges")
-        processEdges()
+        batches = getBatches()
+        for i, edges in enumerate(batches):
+            print(f"  processing batch {i + 1} of {len(batches)} ({len(edges)} edges)")
+            processBatch(conn, edges)
         
-        print("  writing results")
-        writeResults(conn)
         # replace index on geometry field
         query = f"""
             DROP INDEX IF EXISTS {dbTargetSchema}.{dbTargetSchema}_{dbTargetTable}_geometry_idx;
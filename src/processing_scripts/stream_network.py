@@ -0,0 +1,681 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Shared stream network model used by the scripts that walk the network
+# (smooth_z, compute_mainstems, compute_updown_barriers_fish and
+# compute_barriers_upstream_values).
+#
+# DESCRIPTION
+#
+# The network is built once from the streams table and stored in compact
+# numpy arrays instead of Python Node/Edge objects:
+# -	nodes are the unique (x, y) end points of the stream segments
+# -	edges are the stream segments; each edge stores the index of its from node
+#   (upstream end) and its to node (downstream end), its length (metres),
+#   strahler order and the stream id
+# -	in and out edges for each node are stored in CSR form: the edges
+#   flowing out of node n are outedges[outptr[n]:outptr[n+1]] and the
+#   edges flowing into node n are inedges[inptr[n]:inptr[n+1]]
+#
+# Scripts that need extra per edge attributes query them by stream id
+# and align them to the network with StreamNetwork.indexOf.
+#
+# Traversal
+# -	getTopologicalOrder returns the nodes ordered from the headwaters to the
+#   outlets (every node comes after all the nodes upstream of it). It is
+#   computed once with in-degree counters (Kahn's algorithm) so each node and
+#   edge is visited exactly once.
+# -	walkDownstream / walkUpstream call a function for each node in
+#   headwater to outlet / outlet to headwater order.
+# -	accumulateDownstream / accumulateUpstream are vectorized kernels that
+#   carry per edge values down (or up) the network one level at a time;
+#   for example upstream length totals or the longest upstream path.
+# -	reachDownstream / reachUpstream carry sets of items (barriers) down
+#   (or up) the network as shared chains of entries (see ReachSets) so a
+#   set is only expanded for an edge when it is written.
+# -	getBasins splits the network into independent drainage basins (the
+#   edges connected to the same outlets) so steps that only follow
+#   connected edges can process one basin at a time.
+#
+# The built network is kept in memory for the rest of the run so each
+# step doesn't rebuild it. Any script that changes the stream topology
+# (preprocess_watershed, remove_isolated_flowpaths, break_streams_at_barriers)
+# must call invalidateNetwork when it is done.
+#
+# Stream end points
+# -	updateEndpoints adds start_point / end_point columns to the stream table
+#   with GiST indexes; queries that match streams by their end points should
+#   use these columns so the joins are index lookups. preprocess_watershed and
+#   break_streams_at_barriers call it after they change the stream geometries.
+#
+# Disk cache
+# -	if [NETWORK] cache_directory is set in the config file the network arrays
+#   are also saved as .npy files in that directory and memory mapped when they
+#   are loaded again (by later steps or reruns)
+# -	the cached files are keyed by a fingerprint of the stream table (row count,
+#   max id and a checksum of the geometry and strahler order) computed in the
+#   database, so a changed stream table is never read from a stale cache
+#
+import appconfig
+import shapely
+import numpy as np
+import uuid
+import os
+import shutil
+from collections import deque
+
+networkCacheDir = appconfig.config.get('NETWORK', 'cache_directory', fallback='').strip()
+
+#arrays written to and read from the disk cache
+_cachearrays = ['fids', 'length', 'strahler', 'nodex', 'nodey', 'fromNode',
+    'toNode', 'outptr', 'outedges', 'inptr', 'inedges']
+
+_networks = dict()
+
+class StreamNetwork:
+
+    def __init__(self, fids, startxy, endxy, length, strahler):
+        """
+        :param fids: array (S16) of stream ids as uuid bytes
+        :param startxy: (edges, 2) array of the first coordinate of each edge
+        :param endxy: (edges, 2) array of the last coordinate of each edge
+        :param length: array of edge lengths
+        :param strahler: array of edge strahler orders
+        """
+        edgecnt = len(fids)
+
+        self.fids = np.asarray(fids, dtype='S16')
+        self.length = np.asarray(length, dtype=np.float64)
+        self.strahler = np.asarray(strahler, dtype=np.int16)
+
+        #nodes are matched on exact coordinates
+        coords = np.concatenate((np.asarray(startxy, dtype=np.float64).reshape(-1, 2),
+                                 np.asarray(endxy, dtype=np.float64).reshape(-1, 2)))
+        nodexy, inverse = np.unique(coords, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1).astype(np.int32)
+
+        self.nodex = nodexy[:, 0].copy()
+        self.nodey = nodexy[:, 1].copy()
+        self.fromNode = inverse[:edgecnt]
+        self.toNode = inverse[edgecnt:]
+
+        self.outptr, self.outedges = _csr(self.fromNode, len(nodexy))
+        self.inptr, self.inedges = _csr(self.toNode, len(nodexy))
+
+        self._reset()
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """
+        Creates a network from previously built arrays (see save)
+        without recomputing the nodes
+
+        :param arrays: dictionary of array name to array
+        """
+        network = cls.__new__(cls)
+        for name in _cachearrays:
+            setattr(network, name, arrays[name])
+        network._reset()
+        return network
+
+    def _reset(self):
+        self._fidorder = None
+        self._order = None
+        self._downlevel = None
+        self._uplevel = None
+        self._basins = None
+
+    @property
+    def edgeCount(self):
+        return len(self.fids)
+
+    @property
+    def nodeCount(self):
+        return len(self.nodex)
+
+    def getOutEdges(self, node):
+        return self.outedges[self.outptr[node]:self.outptr[node + 1]]
+
+    def getInEdges(self, node):
+        return self.inedges[self.inptr[node]:self.inptr[node + 1]]
+
+    def getOutDegree(self):
+        return np.diff(self.outptr)
+
+    def getInDegree(self):
+        return np.diff(self.inptr)
+
+    def getTopologicalOrder(self):
+        """
+        Returns the node indices ordered from the headwaters to the outlets.
+        Nodes that are part of a cycle can never be reached and are not included.
+        """
+        if (self._order is None):
+            self._computeOrder()
+        return self._order
+
+    def getDownstreamLevels(self):
+        """
+        Returns for each node the number of edges on the longest path
+        from a headwater node to the node (headwaters are level 0)
+        """
+        if (self._order is None):
+            self._computeOrder()
+        return self._downlevel
+
+    def getUpstreamLevels(self):
+        """
+        Returns for each node the number of edges on the longest path
+        from the node to an outlet node (outlets are level 0)
+        """
+        if (self._uplevel is None):
+            order = self.getTopologicalOrder()
+            level = np.zeros(self.nodeCount, dtype=np.int64)
+            outptr = self.outptr.tolist()
+            outedges = self.outedges.tolist()
+            tonode = self.toNode.tolist()
+            levels = level.tolist()
+            for node in reversed(order.tolist()):
+                for edge in outedges[outptr[node]:outptr[node + 1]]:
+                    if (levels[tonode[edge]] + 1 > levels[node]):
+                        levels[node] = levels[tonode[edge]] + 1
+            self._uplevel = np.array(levels, dtype=np.int64)
+        return self._uplevel
+
+    def _computeOrder(self):
+        #each node is ready once all of its in edges have been visited
+        remaining = self.getInDegree().tolist()
+        outptr = self.outptr.tolist()
+        outedges = self.outedges.tolist()
+        tonode = self.toNode.tolist()
+        level = [0] * self.nodeCount
+
+        order = []
+        toprocess = deque(node for node in range(self.nodeCount) if remaining[node] == 0)
+        while (toprocess):
+            node = toprocess.popleft()
+            order.append(node)
+            for edge in outedges[outptr[node]:outptr[node + 1]]:
+                downnode = tonode[edge]
+                if (level[node] + 1 > level[downnode]):
+                    level[downnode] = level[node] + 1
+                remaining[downnode] -= 1
+                if (remaining[downnode] == 0):
+                    toprocess.append(downnode)
+
+        if (len(order) != self.nodeCount):
+            print("    WARNING: stream network contains cycles; " + str(self.nodeCount - len(order)) + " nodes will not be processed")
+
+        self._order = np.array(order, dtype=np.int64)
+        self._downlevel = np.array(level, dtype=np.int64)
+
+    def getBasins(self):
+        """
+        Returns for each edge the id of the drainage basin it belongs to.
+        A basin is all the edges connected (up or downstream) to one or
+        more outlets, so no path in the network leaves a basin and each
+        basin can be processed on its own. Basins are numbered from 0 in
+        order of their first edge.
+        """
+        if (self._basins is None):
+            #union-find on the nodes of each edge
+            parent = list(range(self.nodeCount))
+
+            def find(node):
+                while parent[node] != node:
+                    parent[node] = parent[parent[node]]
+                    node = parent[node]
+                return node
+
+            for fromnode, tonode in zip(self.fromNode.tolist(), self.toNode.tolist()):
+                a = find(fromnode)
+                b = find(tonode)
+                if (a != b):
+                    parent[a] = b
+
+            roots = np.array([find(node) for node in self.fromNode.tolist()], dtype=np.int64)
+            unique, first, inverse = np.unique(roots, return_index=True, return_inverse=True)
+            rank = np.empty(len(unique), dtype=np.int64)
+            rank[np.argsort(first, kind='stable')] = np.arange(len(unique))
+            self._basins = rank[inverse.reshape(-1)]
+        return self._basins
+
+    def reachDownstream(self, nodes, items):
+        """
+        Carries items at nodes down the network; the set of an edge is the
+        items at its from node plus the sets of all edges into that node
+        (for example the barriers upstream of each edge)
+
+        :param nodes: node of each item
+        :param items: item values (integers)
+        :return: ReachSets
+        """
+        return self._reach(nodes, items, self.getTopologicalOrder().tolist(),
+            self.inptr, self.inedges, self.fromNode, self.fromNode)
+
+    def reachUpstream(self, nodes, items):
+        """
+        Carries items at nodes up the network; the set of an edge is the
+        items at its to node plus the sets of all edges out of that node
+        (for example the barriers downstream of each edge)
+
+        :param nodes: node of each item
+        :param items: item values (integers)
+        :return: ReachSets
+        """
+        return self._reach(nodes, items, reversed(self.getTopologicalOrder().tolist()),
+            self.outptr, self.outedges, self.toNode, self.toNode)
+
+    def _reach(self, nodes, items, order, ptr, edges, source, target):
+        #source is the node each edge in edges continues from and 
+        #target the node whose entry each edge gets
+        pairs = np.unique(np.column_stack((np.asarray(nodes, dtype=np.int64), 
+            np.asarray(items, dtype=np.int64))).reshape(-1, 2), axis=0)
+        itemptr, _ = _csr(pairs[:, 0], self.nodeCount)
+        nodeitems = pairs[:, 1]
+
+        ptr = ptr.tolist()
+        edges = edges.tolist()
+        source = source.tolist()
+        itemptr = itemptr.tolist()
+
+        nodeentry = [-1] * self.nodeCount
+        entryitems = []
+        entryparents = []
+        for node in order:
+            parents = set(nodeentry[source[edge]] for edge in edges[ptr[node]:ptr[node + 1]])
+            parents.discard(-1)
+            if (itemptr[node] < itemptr[node + 1] or len(parents) > 1):
+                nodeentry[node] = len(entryitems)
+                entryitems.append(nodeitems[itemptr[node]:itemptr[node + 1]])
+                entryparents.append(tuple(sorted(parents)))
+            elif (len(parents) == 1):
+                nodeentry[node] = parents.pop()
+
+        edgeentry = np.array(nodeentry, dtype=np.int64)[target]
+        return ReachSets(edgeentry, entryitems, entryparents)
+
+    def walkDownstream(self, visit, nodes=None):
+        """
+        Calls visit(node) for each node from the headwaters to the outlets.
+        When a node is visited all nodes upstream of it have been visited.
+
+        :param nodes: optional boolean array (one per node); only the
+            nodes that are true are visited
+        """
+        for node in self._walkOrder(nodes).tolist():
+            visit(node)
+
+    def walkUpstream(self, visit, nodes=None):
+        """
+        Calls visit(node) for each node from the outlets to the headwaters.
+        When a node is visited all nodes downstream of it have been visited.
+
+        :param nodes: optional boolean array (one per node); only the
+            nodes that are true are visited
+        """
+        for node in reversed(self._walkOrder(nodes).tolist()):
+            visit(node)
+
+    def _walkOrder(self, nodes):
+        order = self.getTopologicalOrder()
+        if (nodes is not None):
+            order = order[nodes[order]]
+        return order
+
+    def accumulateDownstream(self, values, nodevalues=None, combine=np.add, aggregate=np.add, reset=None):
+        """
+        Carries edge values down the network. For each edge e:
+          nodeagg[n] = aggregate(nodevalues[n], result[i] for each edge i into n)
+          result[e] = combine(values[e], nodeagg[fromNode[e]])
+        unless reset[e] is true, in which case result[e] = values[e].
+
+        With the defaults the result is the total of values for the edge and
+        everything upstream of it.
+
+        :param values: array of shape (edges,) or (edges, k)
+        :param nodevalues: starting value of the node aggregates, zeros if not provided
+        :param combine: ufunc used to combine an edge value with its from node aggregate
+        :param aggregate: ufunc (supporting .at) used to aggregate edges into a node
+        :param reset: optional boolean array; edges that don't receive upstream values
+        :return: (result, nodeagg)
+        """
+        return self._accumulate(values, nodevalues, combine, aggregate, reset,
+            self.fromNode, self.toNode, self.getDownstreamLevels())
+
+    def accumulateUpstream(self, values, nodevalues=None, combine=np.add, aggregate=np.add, reset=None):
+        """
+        Carries edge values up the network. Same as accumulateDownstream
+        with the direction reversed:
+          nodeagg[n] = aggregate(nodevalues[n], result[i] for each edge i out of n)
+          result[e] = combine(values[e], nodeagg[toNode[e]])
+
+        :return: (result, nodeagg)
+        """
+        return self._accumulate(values, nodevalues, combine, aggregate, reset,
+            self.toNode, self.fromNode, self.getUpstreamLevels())
+
+    def _accumulate(self, values, nodevalues, combine, aggregate, reset, source, target, level):
+        values = np.asarray(values)
+        if (nodevalues is None):
+            nodeagg = np.zeros((self.nodeCount,) + values.shape[1:], dtype=values.dtype)
+        else:
+            nodeagg = np.array(nodevalues, copy=True)
+        result = np.empty_like(values)
+
+        #group edges by the level of their source node; all edges into
+        #a node at level l come from nodes at levels < l
+        edgelevel = level[source]
+        edgeorder = np.argsort(edgelevel, kind='stable')
+        bounds = np.searchsorted(edgelevel[edgeorder], np.arange(edgelevel.max(initial=0) + 2))
+
+        for l in range(len(bounds) - 1):
+            edges = edgeorder[bounds[l]:bounds[l + 1]]
+            if (len(edges) == 0):
+                continue
+            levelvalues = combine(values[edges], nodeagg[source[edges]])
+            if (reset is not None):
+                levelvalues[reset[edges]] = values[edges][reset[edges]]
+            result[edges] = levelvalues
+            aggregate.at(nodeagg, target[edges], levelvalues)
+
+        return result, nodeagg
+
+    def findNodes(self, x, y, tolerance):
+        """
+        Finds the nodes within tolerance of each point using a grid
+        hash of the node coordinates
+
+        :param x: array of point x coordinates
+        :param y: array of point y coordinates
+        :param tolerance: maximum distance between the point and node
+        :return: (points, nodes) arrays with an entry for each point/node pair
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if (len(x) == 0 or self.nodeCount == 0):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        nodecx = np.floor(self.nodex / tolerance).astype(np.int64)
+        nodecy = np.floor(self.nodey / tolerance).astype(np.int64)
+        pntcx = np.floor(x / tolerance).astype(np.int64)
+        pntcy = np.floor(y / tolerance).astype(np.int64)
+
+        #cell keys; the grid is padded by one cell on each side
+        minx = min(nodecx.min(), pntcx.min()) - 1
+        miny = min(nodecy.min(), pntcy.min()) - 1
+        height = max(nodecy.max(), pntcy.max()) - miny + 2
+
+        nodekey = (nodecx - minx) * height + (nodecy - miny)
+        nodeorder = np.argsort(nodekey, kind='stable')
+        nodekey = nodekey[nodeorder]
+
+        points = []
+        nodes = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                key = (pntcx + dx - minx) * height + (pntcy + dy - miny)
+                start = np.searchsorted(nodekey, key, side='left')
+                counts = np.searchsorted(nodekey, key, side='right') - start
+                total = counts.sum()
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                points.append(np.repeat(np.arange(len(x)), counts))
+                nodes.append(nodeorder[np.repeat(start, counts) + offsets])
+
+        points = np.concatenate(points)
+        nodes = np.concatenate(nodes)
+        near = np.hypot(self.nodex[nodes] - x[points], self.nodey[nodes] - y[points]) <= tolerance
+        return points[near], nodes[near]
+
+    def save(self, directory):
+        """
+        Writes the network arrays to .npy files in the directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in _cachearrays:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+
+    def getFid(self, edge):
+        """
+        Returns the stream id (uuid) of the edge
+        """
+        return _toUuid(self.fids[edge])
+
+    def getFids(self):
+        """
+        Returns the stream ids (uuid) of all edges in edge order
+        """
+        return [_toUuid(f) for f in self.fids]
+
+    def indexOf(self, fids):
+        """
+        Returns the edge index of each of the given stream ids; -1 for
+        ids that are not part of the network
+
+        :param fids: iterable of uuid stream ids
+        """
+        if (self._fidorder is None):
+            self._fidorder = np.argsort(self.fids, kind='stable')
+
+        keys = np.array([f.bytes for f in fids], dtype='S16')
+        if (len(keys) == 0 or self.edgeCount == 0):
+            return np.full(len(keys), -1, dtype=np.int64)
+
+        sortedfids = self.fids[self._fidorder]
+        pos = np.searchsorted(sortedfids, keys)
+        pos = np.minimum(pos, self.edgeCount - 1)
+
+        index = self._fidorder[pos].astype(np.int64)
+        index[sortedfids[pos] != keys] = -1
+        return index
+
+
+def _csr(nodeids, nodecnt):
+    """
+    Groups edges by node returning (ptr, edges) so the edges of
+    node n are edges[ptr[n]:ptr[n+1]]. Edges keep their relative
+    order within a node.
+    """
+    edges = np.argsort(nodeids, kind='stable').astype(np.int32)
+    ptr = np.zeros(nodecnt + 1, dtype=np.int64)
+    np.cumsum(np.bincount(nodeids, minlength=nodecnt), out=ptr[1:])
+    return ptr, edges
+
+def _toUuid(fid):
+    #numpy drops trailing null bytes from S16 values
+    return uuid.UUID(bytes=bytes(fid).ljust(16, b'\x00'))
+
+
+def updateEndpoints(connection, schema, table):
+    """
+    Adds (or recomputes) the indexed start_point and end_point
+    columns of the stream table
+    """
+    query = f"""
+        ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS start_point geometry(Point, {appconfig.dataSrid});
+        ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS end_point geometry(Point, {appconfig.dataSrid});
+
+        UPDATE {schema}.{table} SET 
+            start_point = st_startpoint({appconfig.dbGeomField}),
+            end_point = st_endpoint({appconfig.dbGeomField});
+
+        CREATE INDEX IF NOT EXISTS {schema}_{table}_start_point_idx ON {schema}.{table} USING gist(start_point);
+        CREATE INDEX IF NOT EXISTS {schema}_{table}_end_point_idx ON {schema}.{table} USING gist(end_point);
+
+        ANALYZE {schema}.{table};
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    connection.commit()
+
+class ReachSets:
+    """
+    The sets of items (for example barrier indices) found up or downstream
+    of each edge (see StreamNetwork.reachDownstream / reachUpstream).
+
+    Sets are not stored per edge. They are stored as shared entries that
+    point to the entries they continue from; an entry is only created at a
+    node that holds items or where non empty sets from more than one edge
+    meet, and every other edge shares the entry of the edge before it. Memory
+    grows with the number of items and confluences instead of edges x items.
+    The set of an edge is expanded with getItems when it is needed.
+    """
+
+    def __init__(self, edgeentry, items, parents):
+        """
+        :param edgeentry: entry of each edge (-1 for an empty set)
+        :param items: array of the items added by each entry
+        :param parents: tuple of the entries each entry continues from
+        """
+        self.edgeEntry = edgeentry
+        self._items = items
+        self._parents = parents
+
+    @property
+    def entryCount(self):
+        return len(self._items)
+
+    def getItems(self, edge):
+        """
+        Returns the items in the set of the edge in increasing order
+        """
+        entry = int(self.edgeEntry[edge])
+        if (entry < 0):
+            return np.zeros(0, dtype=np.int64)
+
+        #entries can be reached along more than one path 
+        #where channels split and join again
+        visited = {entry}
+        toprocess = [entry]
+        items = []
+        while (toprocess):
+            entry = toprocess.pop()
+            items.append(self._items[entry])
+            for parent in self._parents[entry]:
+                if (parent not in visited):
+                    visited.add(parent)
+                    toprocess.append(parent)
+        return np.unique(np.concatenate(items))
+
+def createNetwork(connection, schema, table):
+    """
+    Builds a StreamNetwork from the stream table. Only the end
+    points of each stream are fetched, not the full geometry.
+    """
+    query = f"""
+        SELECT a.{appconfig.dbIdField}, st_length(a.{appconfig.dbGeomField}), a.strahler_order,
+            st_x(st_startpoint(a.{appconfig.dbGeomField})), st_y(st_startpoint(a.{appconfig.dbGeomField})),
+            st_x(st_endpoint(a.{appconfig.dbGeomField})), st_y(st_endpoint(a.{appconfig.dbGeomField}))
+        FROM {schema}.{table} a
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+
+    fids = np.array([feature[0].bytes for feature in features], dtype='S16')
+    values = np.array([feature[1:] for feature in features], dtype=np.float64).reshape(-1, 6)
+
+    length = values[:, 0]
+    strahler = np.nan_to_num(values[:, 1]).astype(np.int16)
+
+    return StreamNetwork(fids, values[:, 2:4], values[:, 4:6], length, strahler)
+
+def getCoordinates(wkbs, include_z=False):
+    """
+    Decodes a list of (e)wkb geometries (bytes, memoryview or hex) returning
+    a list with the coordinate array of each geometry. All geometries
+    are decoded in a single vectorized call.
+    """
+    if (len(wkbs) == 0):
+        return []
+    wkbs = [bytes(wkb) if isinstance(wkb, memoryview) else wkb for wkb in wkbs]
+    geoms = shapely.from_wkb(np.array(wkbs, dtype=object))
+    coords = shapely.get_coordinates(geoms, include_z=include_z)
+    counts = shapely.get_num_coordinates(geoms)
+    return np.split(coords, np.cumsum(counts)[:-1])
+
+def getFingerprint(connection, schema, table):
+    """
+    Returns a string that changes whenever the geometry or
+    strahler order of any stream in the table changes
+    """
+    query = f"""
+        SELECT count(*), max(a.{appconfig.dbIdField}::text),
+            md5(string_agg(md5(st_asbinary(a.{appconfig.dbGeomField})::text || coalesce(a.strahler_order::text, '')), '' ORDER BY a.{appconfig.dbIdField}))
+        FROM {schema}.{table} a
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        row = cursor.fetchone()
+
+    return f"{row[0]}_{row[1]}_{row[2]}"
+
+def loadNetwork(directory):
+    """
+    Loads a network saved with StreamNetwork.save; the arrays
+    are memory mapped read only
+    """
+    arrays = {}
+    for name in _cachearrays:
+        arrays[name] = np.load(os.path.join(directory, name + ".npy"), mmap_mode='r')
+    return StreamNetwork.fromArrays(arrays)
+
+def _getCachedNetwork(connection, schema, table):
+    fingerprint = getFingerprint(connection, schema, table)
+    tabledir = os.path.join(networkCacheDir, f"{schema}.{table}")
+    cachedir = os.path.join(tabledir, uuid.uuid5(uuid.NAMESPACE_OID, fingerprint).hex)
+
+    if (os.path.isfile(os.path.join(cachedir, "complete"))):
+        print("    loading stream network from cache " + cachedir)
+        return loadNetwork(cachedir)
+
+    network = createNetwork(connection, schema, table)
+
+    #only one version of each table is kept; write to a temporary
+    #directory first so a failed write is never loaded
+    if (os.path.isdir(tabledir)):
+        shutil.rmtree(tabledir, ignore_errors=True)
+    tempdir = cachedir + ".tmp"
+    network.save(tempdir)
+    open(os.path.join(tempdir, "complete"), "w").close()
+    os.replace(tempdir, cachedir)
+
+    return network
+
+def getNetwork(connection, schema, table):
+    """
+    Returns the network for the stream table, building it if
+    it hasn't already been built during this run (or loading it
+    from the disk cache if one is configured)
+    """
+    key = (schema, table)
+    if (key not in _networks):
+        if (networkCacheDir != ''):
+            _networks[key] = _getCachedNetwork(connection, schema, table)
+        else:
+            _networks[key] = createNetwork(connection, schema, table)
+    return _networks[key]
+
+def invalidateNetwork(schema, table):
+    """
+    Discards the network for the stream table; must be called
+    after the stream topology changes
+    """
+    _networks.pop((schema, table), None)
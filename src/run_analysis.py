@@ -57,10 +57,6 @@ assign_raw_z.main()
 smooth_z.main()
 compute_vertex_gradient.main()
 break_streams_at_barriers.main()
-print ("Recalculating elevations on broken streams: " + workingWatershedId)
-# re-assign elevations to broken streams
-assign_raw_z.main()
-smooth_z.main()
 compute_segment_gradient.main()
 compute_updown_barriers_fish.main()
 compute_accessibility.main()